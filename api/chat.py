@@ -1,11 +1,15 @@
 import os
-from fastapi import FastAPI, Body, HTTPException
+from fastapi import FastAPI, Body, HTTPException, Header
 from fastapi.middleware.cors import CORSMiddleware
 
 # Reuse logic by importing from index.py
-from .index import process_query_non_streaming  # type: ignore
+from .index import process_query_non_streaming, _Overloaded, _overloaded_response  # type: ignore
+from .index import _UpstreamUnavailable, _upstream_unavailable_response  # type: ignore
+from .index import _sse_chat_events, _sse_response, _wants_stream, _wants_suggestions  # type: ignore
 
 app = FastAPI()
+app.add_exception_handler(_Overloaded, _overloaded_response)
+app.add_exception_handler(_UpstreamUnavailable, _upstream_unavailable_response)
 
 # CORS: allow same-origin and typical usage
 app.add_middleware(
@@ -17,19 +21,22 @@ app.add_middleware(
 )
 
 @app.get("/")
-async def chat_query(q: str = ""):
+async def chat_query(q: str = "", cache: str = "default"):
     if not q:
         raise HTTPException(status_code=400, detail="Missing q")
-    response = await process_query_non_streaming(q)
+    response = await process_query_non_streaming(q, cache=cache)
     return {"response": response}
 
 @app.post("/")
-async def chat_post(payload: dict = Body(...)):
+async def chat_post(payload: dict = Body(...), accept: str | None = Header(default=None)):
     prompt = (payload or {}).get("prompt") or (payload or {}).get("query") or ""
     attachment = (payload or {}).get("attachment")
     if not isinstance(prompt, str) or not prompt.strip():
         raise HTTPException(status_code=400, detail="Missing prompt")
-    response = await process_query_non_streaming(prompt, attachment if isinstance(attachment, dict) else None)
+    if _wants_stream(payload, accept):
+        return _sse_response(_sse_chat_events(prompt, attachment if isinstance(attachment, dict) else None, _wants_suggestions(payload)))
+    cache = (payload or {}).get("cache") or "default"
+    response = await process_query_non_streaming(prompt, attachment if isinstance(attachment, dict) else None, cache=cache)
     return {"response": response}
 
 
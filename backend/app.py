@@ -1,19 +1,41 @@
 import os
+import asyncio
 from dotenv import load_dotenv
 from fastapi import FastAPI, WebSocket, APIRouter
 from fastapi import Body, HTTPException, Header
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, StreamingResponse
+from google.api_core import exceptions as google_exceptions
 from google.generativeai import GenerativeModel, configure
+from google.generativeai import client as genai_client
 from google.generativeai.types import GenerationConfig
 from googleapiclient.discovery import build
+from googleapiclient.http import build_http
 import logging
 import secrets
+import hmac
+import threading
 import smtplib
 import ssl
 from email.message import EmailMessage
 import io
+import json
+import base64
+import hashlib
+import re
+import ipaddress
+import socket
+import heapq
+import itertools
+import math
+import random
+import contextlib
+from concurrent.futures import ThreadPoolExecutor
+from html.parser import HTMLParser
+from collections import OrderedDict, deque
 from typing import Optional, Tuple
 import time
+import datetime
 import jwt
 from passlib.context import CryptContext
 from pymongo import MongoClient
@@ -27,6 +49,11 @@ except Exception:
     Image = None
     pymupdf = None
 
+try:
+    import httpx  # type: ignore[reportMissingImports]
+except Exception:
+    httpx = None
+
 # Set up logging
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
@@ -68,6 +95,93 @@ SMTP_USER = os.getenv("SMTP_USER", "")
 SMTP_PASS = os.getenv("SMTP_PASS", "")
 SMTP_FROM = os.getenv("SMTP_FROM", "")
 APP_URL = os.getenv("APP_URL", "http://localhost:3000")
+STREAM_COALESCE_BYTES = int(os.getenv("STREAM_COALESCE_BYTES", "512") or 512)
+STREAM_COALESCE_WINDOW_MS = float(os.getenv("STREAM_COALESCE_WINDOW_MS", "30") or 30)
+SSE_KEEPALIVE_SECONDS = float(os.getenv("SSE_KEEPALIVE_SECONDS", "15") or 15)
+LLM_PROVIDER = os.getenv("LLM_PROVIDER", "gemini").lower()
+FAKE_LLM_TTFT_SECONDS = float(os.getenv("FAKE_LLM_TTFT_SECONDS", "0.3") or 0.3)
+FAKE_LLM_CHUNK_DELAY_SECONDS = float(os.getenv("FAKE_LLM_CHUNK_DELAY_SECONDS", "0.05") or 0.05)
+FAKE_LLM_CHUNKS = int(os.getenv("FAKE_LLM_CHUNKS", "20") or 20)
+FAKE_LLM_ERROR_RATE = float(os.getenv("FAKE_LLM_ERROR_RATE", "0") or 0)
+FAKE_LLM_RESPONSE = os.getenv("FAKE_LLM_RESPONSE", "")
+FAKE_LLM_SEED = int(os.getenv("FAKE_LLM_SEED", "0") or 0)
+# Model tiers and routing rules; override with JSON in MODEL_TIERS / ROUTING_RULES (or a ROUTING_RULES_FILE).
+# A rule may set "max_output_tokens"; without one the model's own limit applies. Note that on thinking
+# models (2.5-flash) thinking tokens count against that cap, so keep operator caps generous.
+MODEL_TIERS = {"fast": "gemini-2.5-flash-lite", "standard": "gemini-2.5-flash"}
+ROUTING_RULES = [
+    {"when": {"has_attachment": True}, "tier": "standard"},
+    {"when": {"code_hint": True}, "tier": "standard"},
+    {"when": {"needs_search": True}, "tier": "standard"},
+    # Short one-off prompts only: a terse follow-up ("why?") in a long conversation still needs the standard tier
+    {"when": {"max_prompt_chars": 160, "max_history_chars": 2000}, "tier": "fast"},
+    {"tier": "standard"},
+]
+PROMPT_TOKEN_BUDGET = int(os.getenv("PROMPT_TOKEN_BUDGET", "12000") or 12000)
+# Relative shares of the prompt budget; leftover from sections that need less flows to the rest
+PROMPT_SECTION_WEIGHTS = {"query": 4.0, "search": 2.0, "ocr": 2.0, "history": 1.0}
+RESPONSE_CACHE_TTL_SECONDS = int(os.getenv("RESPONSE_CACHE_TTL_SECONDS", "3600") or 3600)
+RESPONSE_CACHE_SEARCH_TTL_SECONDS = int(os.getenv("RESPONSE_CACHE_SEARCH_TTL_SECONDS", "300") or 300)
+RESPONSE_CACHE_MAX_ENTRIES = int(os.getenv("RESPONSE_CACHE_MAX_ENTRIES", "1000") or 1000)
+RESPONSE_CACHE_MAX_BYTES = int(os.getenv("RESPONSE_CACHE_MAX_BYTES", str(32 * 1024 * 1024)) or 32 * 1024 * 1024)
+SUGGESTIONS_CACHE_TTL_SECONDS = int(os.getenv("SUGGESTIONS_CACHE_TTL_SECONDS", "86400") or 86400)
+SUGGESTIONS_CACHE_MAX_ENTRIES = int(os.getenv("SUGGESTIONS_CACHE_MAX_ENTRIES", "5000") or 5000)
+SUGGESTIONS_CACHE_MAX_BYTES = int(os.getenv("SUGGESTIONS_CACHE_MAX_BYTES", str(8 * 1024 * 1024)) or 8 * 1024 * 1024)
+# Shared Mongo tier so serverless instances keep hits across cold starts
+SUGGESTIONS_CACHE_MONGO = os.getenv("SUGGESTIONS_CACHE_MONGO", "false").lower() in ("1", "true", "yes")
+SEARCH_CACHE_TTL_SECONDS = int(os.getenv("SEARCH_CACHE_TTL_SECONDS", "900") or 900)
+# Errors and empty results are cached briefly so a failing or useless query doesn't burn quota on every request
+SEARCH_NEGATIVE_TTL_SECONDS = int(os.getenv("SEARCH_NEGATIVE_TTL_SECONDS", "60") or 60)
+SEARCH_CACHE_MAX_ENTRIES = int(os.getenv("SEARCH_CACHE_MAX_ENTRIES", "5000") or 5000)
+SEARCH_CACHE_MAX_BYTES = int(os.getenv("SEARCH_CACHE_MAX_BYTES", str(8 * 1024 * 1024)) or 8 * 1024 * 1024)
+SEARCH_CACHE_MONGO = os.getenv("SEARCH_CACHE_MONGO", "false").lower() in ("1", "true", "yes")
+# Fan-out search: run a few rewrites of the query in parallel and merge them with reciprocal-rank fusion
+SEARCH_FANOUT_ENABLED = os.getenv("SEARCH_FANOUT_ENABLED", "false").lower() in ("1", "true", "yes")
+SEARCH_FANOUT_MAX_PER_DOMAIN = int(os.getenv("SEARCH_FANOUT_MAX_PER_DOMAIN", "1") or 1)
+SEARCH_FANOUT_RRF_K = int(os.getenv("SEARCH_FANOUT_RRF_K", "60") or 60)
+# Search-intent classifier: queries scoring at or above the threshold trigger a web search.
+# SEARCH_INTENT_MODEL_FILE points at JSON {"bias": float, "weights": {ngram: float}, "threshold"?: float}
+SEARCH_INTENT_THRESHOLD = float(os.getenv("SEARCH_INTENT_THRESHOLD", "0.5") or 0.5)
+SEARCH_INTENT_MODEL_FILE = os.getenv("SEARCH_INTENT_MODEL_FILE", "")
+# Also evaluate the old keyword list and log where the two disagree
+SEARCH_INTENT_SHADOW = os.getenv("SEARCH_INTENT_SHADOW", "true").lower() in ("1", "true", "yes")
+# Optional search enrichment: fetch the top result pages and give the model their text, not just the snippet.
+# SEARCH_ENRICH_BUDGET_SECONDS caps the latency it adds; pages still loading then are left out
+SEARCH_ENRICH_ENABLED = os.getenv("SEARCH_ENRICH_ENABLED", "false").lower() in ("1", "true", "yes")
+SEARCH_ENRICH_TOP_N = int(os.getenv("SEARCH_ENRICH_TOP_N", "3") or 3)
+SEARCH_ENRICH_BUDGET_SECONDS = float(os.getenv("SEARCH_ENRICH_BUDGET_SECONDS", "2.5") or 2.5)
+SEARCH_ENRICH_PAGE_TIMEOUT_SECONDS = float(os.getenv("SEARCH_ENRICH_PAGE_TIMEOUT_SECONDS", "3") or 3)
+SEARCH_ENRICH_MAX_PAGE_BYTES = int(os.getenv("SEARCH_ENRICH_MAX_PAGE_BYTES", str(512 * 1024)) or 512 * 1024)
+SEARCH_ENRICH_MAX_CHARS = int(os.getenv("SEARCH_ENRICH_MAX_CHARS", "3000") or 3000)
+SEARCH_ENRICH_WORKERS = int(os.getenv("SEARCH_ENRICH_WORKERS", "4") or 4)
+SEARCH_ENRICH_CACHE_TTL_SECONDS = int(os.getenv("SEARCH_ENRICH_CACHE_TTL_SECONDS", "3600") or 3600)
+SEARCH_ENRICH_MAX_REDIRECTS = int(os.getenv("SEARCH_ENRICH_MAX_REDIRECTS", "5") or 5)
+# Per-stage deadlines for the pre-LLM work; a stage that misses its deadline is left out of the prompt
+STAGE_TIMEOUT_DECODE_SECONDS = float(os.getenv("STAGE_TIMEOUT_DECODE_SECONDS", "2") or 2)
+STAGE_TIMEOUT_OCR_SECONDS = float(os.getenv("STAGE_TIMEOUT_OCR_SECONDS", "10") or 10)
+STAGE_TIMEOUT_SEARCH_SECONDS = float(os.getenv("STAGE_TIMEOUT_SEARCH_SECONDS", "5") or 5)
+# Latency budget for suggestions when the request doesn't give one; below the minimum only the rule-based path runs
+SUGGESTIONS_LATENCY_BUDGET_MS = int(os.getenv("SUGGESTIONS_LATENCY_BUDGET_MS", "8000") or 8000)
+SUGGESTIONS_MIN_MODEL_BUDGET_MS = int(os.getenv("SUGGESTIONS_MIN_MODEL_BUDGET_MS", "500") or 500)
+SUGGESTIONS_MAX = 5
+# Suggestion requests from concurrent users share one Gemini call; a max size of 1 disables batching
+SUGGESTIONS_BATCH_MAX_SIZE = int(os.getenv("SUGGESTIONS_BATCH_MAX_SIZE", "8") or 8)
+SUGGESTIONS_BATCH_MAX_WAIT_MS = int(os.getenv("SUGGESTIONS_BATCH_MAX_WAIT_MS", "50") or 50)
+GEMINI_INITIAL_CONCURRENCY = int(os.getenv("GEMINI_INITIAL_CONCURRENCY", "8") or 8)
+GEMINI_MIN_CONCURRENCY = int(os.getenv("GEMINI_MIN_CONCURRENCY", "2") or 2)
+GEMINI_MAX_CONCURRENCY = int(os.getenv("GEMINI_MAX_CONCURRENCY", "64") or 64)
+GEMINI_QUEUE_SIZE = int(os.getenv("GEMINI_QUEUE_SIZE", "100") or 100)
+GEMINI_TARGET_LATENCY_SECONDS = float(os.getenv("GEMINI_TARGET_LATENCY_SECONDS", "15") or 15)
+GEMINI_FALLBACK_MODELS = [m.strip() for m in os.getenv("GEMINI_FALLBACK_MODELS", "gemini-2.5-flash-lite").split(",") if m.strip()]
+GEMINI_MAX_RETRIES = int(os.getenv("GEMINI_MAX_RETRIES", "2") or 2)
+GEMINI_RETRY_BASE_SECONDS = float(os.getenv("GEMINI_RETRY_BASE_SECONDS", "0.5") or 0.5)
+GEMINI_RETRY_MAX_SECONDS = float(os.getenv("GEMINI_RETRY_MAX_SECONDS", "8") or 8)
+GEMINI_BREAKER_FAILURES = int(os.getenv("GEMINI_BREAKER_FAILURES", "5") or 5)
+GEMINI_BREAKER_RESET_SECONDS = float(os.getenv("GEMINI_BREAKER_RESET_SECONDS", "30") or 30)
+GEMINI_HEDGE_ENABLED = os.getenv("GEMINI_HEDGE_ENABLED", "false").lower() in ("1", "true", "yes")
+GEMINI_HEDGE_PERCENTILE = float(os.getenv("GEMINI_HEDGE_PERCENTILE", "95") or 95)
+GEMINI_HEDGE_BUDGET = float(os.getenv("GEMINI_HEDGE_BUDGET", "0.05") or 0.05)
+GEMINI_HEDGE_MIN_SAMPLES = int(os.getenv("GEMINI_HEDGE_MIN_SAMPLES", "20") or 20)
 
 def _send_email(subject: str, to_email: str, html_body: str, text_body: str | None = None) -> bool:
     try:
@@ -97,61 +211,590 @@ mongo_client = MongoClient(MONGO_URL) if MONGO_URL else None
 db = mongo_client.get_database(MONGO_DB_NAME) if mongo_client is not None else None
 users_col = db["users"] if db is not None else None
 chats_col = db["chats"] if db is not None else None
+suggestions_cache_col = db["suggestions_cache"] if db is not None and SUGGESTIONS_CACHE_MONGO else None
+search_cache_col = db["search_cache"] if db is not None and SEARCH_CACHE_MONGO else None
 
 # Helper function for web search via Google Custom Search
-def perform_search(query: str, max_results: int = 3):
+_search_service = None
+_search_service_lock = threading.Lock()
+_search_http = threading.local()
+
+
+def _get_search_service():
+    global _search_service
+    if _search_service is None:
+        with _search_service_lock:
+            if _search_service is None:
+                # Bundled discovery document: no network fetch, and it's parsed once per process
+                _search_service = build(
+                    "customsearch", "v1", developerKey=GOOGLE_API_KEY, static_discovery=True, cache_discovery=False
+                )
+    return _search_service
+
+
+def _thread_search_http():
+    # httplib2.Http isn't thread-safe, so each worker thread keeps its own and reuses its keep-alive connection
+    http = getattr(_search_http, "http", None)
+    if http is None:
+        http = _search_http.http = build_http()
+    return http
+
+
+_search_stats = {"calls": 0, "errors": 0, "negative_hits": 0, "mongo_hits": 0, "mongo_misses": 0, "fanout_searches": 0}
+_search_ttl_index_ready = False
+
+
+def _search_mongo_get(key: str) -> dict | None:
+    doc = search_cache_col.find_one({"_id": key, "expiresAt": {"$gt": datetime.datetime.utcnow()}}, {"search": 1})
+    return doc.get("search") if doc else None
+
+
+def _search_mongo_set(key: str, search: dict):
+    global _search_ttl_index_ready
+    if not _search_ttl_index_ready:
+        search_cache_col.create_index("expiresAt", expireAfterSeconds=0)
+        _search_ttl_index_ready = True
+    expires = datetime.datetime.utcnow() + datetime.timedelta(seconds=SEARCH_CACHE_TTL_SECONDS)
+    search_cache_col.update_one({"_id": key}, {"$set": {"search": search, "expiresAt": expires}}, upsert=True)
+
+
+def perform_search(query: str, max_results: int = 3) -> dict:
+    """Return {"results": [{title, snippet, link}], "error": str | None}; formatted later by _format_search_results."""
     if not GOOGLE_API_KEY or not GOOGLE_CSE_ID:
-        return "Search unavailable: Google CSE is not configured."
+        return {"results": [], "error": "Search unavailable: Google CSE is not configured."}
+    key = f"{max_results}:{_normalize_prompt(query)}"
+    cached = _search_cache.get(key)
+    if cached is not None:
+        if cached["error"] or not cached["results"]:
+            _search_stats["negative_hits"] += 1
+        return cached
+    if search_cache_col is not None:
+        try:
+            cached = _search_mongo_get(key)
+        except Exception as e:
+            logger.error(f"Search cache read error: {e}")
+            cached = None
+        _search_stats["mongo_hits" if cached else "mongo_misses"] += 1
+        if cached:
+            _search_cache.set(key, cached, SEARCH_CACHE_TTL_SECONDS)
+            return cached
+
+    _search_stats["calls"] += 1
     try:
-        service = build("customsearch", "v1", developerKey=GOOGLE_API_KEY)
-        res = service.cse().list(q=query, cx=GOOGLE_CSE_ID, num=max_results).execute()
-        items = res.get("items", [])
-        formatted_results = []
-        for idx, item in enumerate(items, 1):
-            title = item.get("title", "Untitled")
-            snippet = item.get("snippet", "")
-            link = item.get("link", "")
-            formatted_results.append(
-                f"**Result {idx}**:\n- **Title**: {title}\n- **Snippet**: {snippet}\n- **Source**: [{link}]({link})\n"
-            )
-        return "\n".join(formatted_results) if formatted_results else "No results found."
+        service = _get_search_service()
+        res = service.cse().list(q=query, cx=GOOGLE_CSE_ID, num=max_results).execute(http=_thread_search_http())
+        results = [
+            {"title": item.get("title", "Untitled"), "snippet": item.get("snippet", ""), "link": item.get("link", "")}
+            for item in res.get("items", [])
+        ]
+        search = {"results": results, "error": None}
     except Exception as e:
         logger.error(f"Google CSE error: {e}")
-        return "Search unavailable due to an error."
+        _search_stats["errors"] += 1
+        search = {"results": [], "error": "Search unavailable due to an error."}
 
-def _build_content_parts(query: str, attachment: dict | None):
-    parts = []
-    parts.append(
-        "You are a helpful coding assistant. Always respond in Markdown.\n"
-        "- When including code, use fenced code blocks with the correct language tag (e.g., ```python, ```html).\n"
-        "- For multi-line code, never inline it; use fenced blocks only.\n"
-        "- Keep prose concise; if code is primary, start with a short title then the code block.\n"
-        "- Do not wrap code in a single paragraph.\n\n"
-    )
-    parts.append(f"User query: {query}")
-    if attachment and attachment.get("data") and attachment.get("mime"):
+    if search["results"]:
+        _search_cache.set(key, search, SEARCH_CACHE_TTL_SECONDS)
+        if search_cache_col is not None:
+            try:
+                _search_mongo_set(key, search)
+            except Exception as e:
+                logger.error(f"Search cache write error: {e}")
+    else:
+        _search_cache.set(key, search, SEARCH_NEGATIVE_TTL_SECONDS)
+    return search
+
+
+_STOPWORDS = {
+    "a", "an", "the", "is", "are", "was", "were", "be", "of", "in", "on", "at", "to", "for", "with", "about",
+    "and", "or", "what", "whats", "who", "when", "where", "which", "how", "why", "do", "does", "did", "can",
+    "could", "should", "would", "i", "me", "my", "you", "your", "tell", "please", "find", "search", "show",
+    "give", "get", "there", "any", "some", "it", "its", "this", "that", "from", "by", "as", "into",
+}
+_QUOTED_RE = re.compile(r'"([^"]+)"')
+_ENTITY_RE = re.compile(r"\b[A-Z][\w.+#-]*(?:\s+[A-Z0-9][\w.+#-]*)*")
+
+
+def _sentence_initial_word_is_name(word: str, text: str) -> bool:
+    # Capitalized by position alone ("Compare", "Best") unless it has inner capitals (SPA, GraphQL) or recurs capitalized
+    return any(c.isupper() for c in word[1:]) or len(re.findall(rf"(?<![\w.+#-]){re.escape(word)}(?![\w.+#-])", text)) > 1
+
+
+def _query_variants(query: str) -> list[str]:
+    """The original query, a keywords-only rewrite and one with named entities quoted; duplicates dropped."""
+    words = re.findall(r"[\w.+#-]+", query)
+    keywords = [w for w in words if w.lower() not in _STOPWORDS]
+    entities = _QUOTED_RE.findall(query)
+    unquoted = _QUOTED_RE.sub(" ", query)
+    for match in _ENTITY_RE.finditer(unquoted):
+        tokens = match.group().split()
+        before = unquoted[:match.start()].rstrip()
+        if (not before or before[-1] in ".!?:") and not _sentence_initial_word_is_name(tokens[0], unquoted):
+            tokens = tokens[1:]
+        # Stopword capitals ("What", "Tell") aren't entities either
+        tokens = [t for t in tokens if t.lower() not in _STOPWORDS]
+        if tokens:
+            entities.append(" ".join(tokens))
+    variants = [query.strip(), " ".join(keywords)]
+    if entities:
+        entity_words = {w.lower() for e in entities for w in e.split()}
+        rest = [w for w in keywords if w.lower() not in entity_words]
+        variants.append(" ".join([f'"{e}"' for e in dict.fromkeys(entities)] + rest))
+    return list(dict.fromkeys(v for v in variants if v))
+
+
+def _url_identity(link: str) -> tuple[str, str]:
+    # (normalized URL, domain): scheme, "www.", fragments and trailing slashes don't make a page distinct
+    match = re.match(r"^(?:https?://)?([^/?#]+)([^#]*)", link.strip(), re.IGNORECASE)
+    if not match:
+        return link, link
+    host = match.group(1).lower()
+    host = host[4:] if host.startswith("www.") else host
+    path = match.group(2).rstrip("/") or ""
+    return f"{host}{path}", host
+
+
+def _reciprocal_rank_fusion(result_lists: list[list[dict]], limit: int, k: int = 60, max_per_domain: int = 1) -> list[dict]:
+    """Merge ranked result lists by summing 1 / (k + rank) per URL; keeps at most max_per_domain results per domain."""
+    scores: dict[str, float] = {}
+    first_seen: dict[str, dict] = {}
+    for results in result_lists:
+        for rank, item in enumerate(results, 1):
+            url, _ = _url_identity(item.get("link", ""))
+            scores[url] = scores.get(url, 0.0) + 1.0 / (k + rank)
+            first_seen.setdefault(url, item)
+    fused: list[dict] = []
+    per_domain: dict[str, int] = {}
+    # sorted() is stable, so ties keep first-seen order (the original query's ranking comes first)
+    for url in sorted(scores, key=lambda u: scores[u], reverse=True):
+        _, domain = _url_identity(first_seen[url].get("link", ""))
+        if per_domain.get(domain, 0) >= max_per_domain:
+            continue
+        per_domain[domain] = per_domain.get(domain, 0) + 1
+        fused.append(first_seen[url])
+        if len(fused) >= limit:
+            break
+    return fused
+
+
+async def _search(query: str, max_results: int = 3) -> dict:
+    if not SEARCH_FANOUT_ENABLED:
+        return await asyncio.to_thread(perform_search, query, max_results)
+    # Variants run in parallel (and are cached individually), so this costs about one search in latency
+    variants = _query_variants(query)
+    searches = await asyncio.gather(*(asyncio.to_thread(perform_search, v, max_results) for v in variants))
+    ok = [search["results"] for search in searches if not search.get("error")]
+    if not ok:
+        return searches[0]
+    _search_stats["fanout_searches"] += 1
+    results = _reciprocal_rank_fusion(ok, max_results, SEARCH_FANOUT_RRF_K, SEARCH_FANOUT_MAX_PER_DOMAIN)
+    return {"results": results, "error": None}
+
+
+def _format_search_results(search: dict, max_tokens: int | None = None) -> str:
+    # With max_tokens, only whole results that fit are kept
+    if search.get("error"):
+        return search["error"]
+    formatted_results = []
+    for idx, item in enumerate(search.get("results", []), 1):
+        link = item["link"]
+        formatted_results.append(
+            f"**Result {idx}**:\n- **Title**: {item['title']}\n- **Snippet**: {item['snippet']}\n- **Source**: [{link}]({link})\n"
+            + (f"- **Page content**: {item['content']}\n" if item.get("content") else "")
+        )
+    if not formatted_results:
+        return "No results found."
+    if max_tokens is not None:
+        # Nothing fits: leave the section out rather than send a fragment
+        return "\n".join(_fit_whole(formatted_results, max_tokens, "\n"))
+    return "\n".join(formatted_results)
+
+class _PageTextExtractor(HTMLParser):
+    """Pulls readable text out of an HTML page, skipping scripts, styles and page chrome."""
+
+    _SKIP = {"script", "style", "noscript", "template", "svg", "nav", "header", "footer", "aside", "form", "iframe"}
+    _BLOCK = {"p", "div", "br", "li", "tr", "h1", "h2", "h3", "h4", "h5", "h6", "section", "article", "pre", "blockquote"}
+
+    def __init__(self):
+        super().__init__(convert_charrefs=True)
+        self._skip_depth = 0
+        self._parts: list[str] = []
+
+    def handle_starttag(self, tag, attrs):
+        if tag in self._SKIP:
+            self._skip_depth += 1
+        elif tag in self._BLOCK:
+            self._parts.append("\n")
+
+    def handle_endtag(self, tag):
+        if tag in self._SKIP:
+            self._skip_depth = max(0, self._skip_depth - 1)
+        elif tag in self._BLOCK:
+            self._parts.append("\n")
+
+    def handle_data(self, data):
+        if not self._skip_depth:
+            self._parts.append(data)
+
+    def text(self) -> str:
+        lines = (" ".join(line.split()) for line in "".join(self._parts).splitlines())
+        return "\n".join(line for line in lines if line)
+
+
+def _extract_page_text(body: bytes, encoding: str, content_type: str) -> str:
+    text = body.decode(encoding or "utf-8", errors="replace")
+    if "html" in content_type:
+        parser = _PageTextExtractor()
         try:
-            import base64
-            # Expect a data URL like: data:<mime>;base64,<payload>
-            data_url = attachment["data"]
-            if data_url.startswith("data:") and ";base64," in data_url:
-                mime = attachment["mime"]
-                b64 = data_url.split(",", 1)[1]
-                raw = base64.b64decode(b64)
-                parts.append({
-                    "inline_data": {
-                        "mime_type": mime,
-                        "data": raw,
-                    }
-                })
-                # OCR preprocessing if available
-                ocr_text = _try_ocr_bytes(raw, mime)
-                if ocr_text:
-                    parts.append("\n\nThe following is text OCR'ed from the attachment (may be imperfect):\n")
-                    parts.append(ocr_text[:8000])
-                parts.append("Consider the attached file when answering.")
-        except Exception as e:
-            logger.error(f"Attachment parse error: {e}")
+            parser.feed(text)
+            parser.close()
+        except Exception:
+            # Truncated or malformed markup; keep whatever parsed before the error
+            pass
+        text = parser.text()
+    else:
+        text = "\n".join(" ".join(line.split()) for line in text.splitlines() if line.strip())
+    return _truncate_to_tokens(text, SEARCH_ENRICH_MAX_CHARS // 4)
+
+
+# HTML parsing is CPU-bound; a dedicated pool keeps it from starving the default executor used for OCR and search
+_enrich_executor = ThreadPoolExecutor(max_workers=SEARCH_ENRICH_WORKERS, thread_name_prefix="enrich")
+_enrich_clients: dict[asyncio.AbstractEventLoop, object] = {}
+_enrich_stats = {"fetched": 0, "cache_hits": 0, "failures": 0, "truncated": 0, "over_budget": 0, "blocked": 0}
+
+
+class _BlockedURL(Exception):
+    pass
+
+
+def _blocked_address(address: str) -> bool:
+    ip = ipaddress.ip_address(address.split("%", 1)[0])
+    if ip.version == 6 and ip.ipv4_mapped:
+        ip = ip.ipv4_mapped
+    # is_global is False for private, loopback, link-local, reserved, shared and unspecified ranges
+    return not ip.is_global or ip.is_multicast
+
+
+async def _public_address(url) -> str:
+    # Result links are untrusted input: never let them point the server at itself or its private network
+    if url.scheme not in ("http", "https") or not url.host:
+        raise _BlockedURL(f"unsupported URL {url}")
+    loop = asyncio.get_running_loop()
+    infos = await loop.getaddrinfo(url.host, url.port or (443 if url.scheme == "https" else 80), type=socket.SOCK_STREAM)
+    if not infos or any(_blocked_address(info[4][0]) for info in infos):
+        raise _BlockedURL(f"{url.host} does not resolve to a public address")
+    return infos[0][4][0].split("%", 1)[0]
+
+
+def _pinned_request(url, address: str) -> dict:
+    # Connect to the address that was checked, not whatever a second DNS lookup returns (DNS rebinding);
+    # Host and SNI keep the original name, so virtual hosting and certificate checks still see it
+    host = url.host if url.port is None else f"{url.host}:{url.port}"
+    return {
+        "url": url.copy_with(host=address),
+        "headers": {"Host": host},
+        "extensions": {"sni_hostname": url.host} if url.scheme == "https" else {},
+    }
+
+
+def _enrich_client():
+    # One pooled client per event loop; connections to popular sites stay alive across requests
+    loop = asyncio.get_running_loop()
+    client = _enrich_clients.get(loop)
+    if client is None:
+        client = _enrich_clients[loop] = httpx.AsyncClient(
+            follow_redirects=False,  # _fetch_page_text follows them itself, checking every hop
+            timeout=httpx.Timeout(SEARCH_ENRICH_PAGE_TIMEOUT_SECONDS),
+            limits=httpx.Limits(max_connections=32, max_keepalive_connections=16),
+            headers={"User-Agent": "Mozilla/5.0 (compatible; ai-agent-enrichment/1.0)"},
+        )
+    return client
+
+
+async def _fetch_page_text(url: str) -> str:
+    cached = _page_text_cache.get(url)
+    if cached is not None:
+        _enrich_stats["cache_hits"] += 1
+        return cached
+    text = ""
+    try:
+        body = bytearray()
+        target = httpx.URL(url)
+        for _ in range(SEARCH_ENRICH_MAX_REDIRECTS + 1):
+            address = await _public_address(target)
+            async with _enrich_client().stream("GET", **_pinned_request(target, address)) as resp:
+                if resp.is_redirect:
+                    # Resolved against the named URL; the pinned one carries the IP instead of the host
+                    target = target.join(resp.headers["location"])
+                    continue
+                content_type = resp.headers.get("content-type", "").lower()
+                if resp.status_code == 200 and ("html" in content_type or content_type.startswith("text/")):
+                    async for chunk in resp.aiter_bytes():
+                        body.extend(chunk)
+                        if len(body) >= SEARCH_ENRICH_MAX_PAGE_BYTES:
+                            # Stop reading; the start of a page carries most of its readable text
+                            del body[SEARCH_ENRICH_MAX_PAGE_BYTES:]
+                            _enrich_stats["truncated"] += 1
+                            break
+                    encoding = resp.encoding
+            break
+        else:
+            raise _BlockedURL(f"more than {SEARCH_ENRICH_MAX_REDIRECTS} redirects")
+        if body:
+            loop = asyncio.get_running_loop()
+            text = await loop.run_in_executor(_enrich_executor, _extract_page_text, bytes(body), encoding, content_type)
+            _enrich_stats["fetched"] += 1
+    except _BlockedURL as e:
+        logger.warning(f"Page fetch refused for {url}: {e}")
+        _enrich_stats["blocked"] += 1
+    except Exception as e:
+        logger.warning(f"Page fetch failed for {url}: {e}")
+        _enrich_stats["failures"] += 1
+    # Failures and non-text pages are remembered briefly so they're not refetched on every request
+    _page_text_cache.set(url, text, SEARCH_ENRICH_CACHE_TTL_SECONDS if text else SEARCH_NEGATIVE_TTL_SECONDS, size=len(text) or 1)
+    return text
+
+
+async def _enrich_search(search: dict) -> dict:
+    """Adds "content" to the top results whose pages load within the page timeout and overall budget."""
+    if httpx is None or search.get("error") or not search.get("results"):
+        return search
+    top = [item for item in search["results"][:SEARCH_ENRICH_TOP_N] if item.get("link", "").startswith(("http://", "https://"))]
+    tasks = {
+        item["link"]: asyncio.ensure_future(asyncio.wait_for(_fetch_page_text(item["link"]), SEARCH_ENRICH_PAGE_TIMEOUT_SECONDS))
+        for item in top
+    }
+    if not tasks:
+        return search
+    _, pending = await asyncio.wait(tasks.values(), timeout=SEARCH_ENRICH_BUDGET_SECONDS)
+    for task in pending:
+        task.cancel()
+    _enrich_stats["over_budget"] += len(pending)
+    contents = {}
+    for link, task in tasks.items():
+        if task.done() and not task.cancelled() and task.exception() is None and task.result():
+            contents[link] = task.result()
+    # Copies, so the cached search entry stays snippet-only
+    results = [{**item, "content": contents[item["link"]]} if item.get("link") in contents else item for item in search["results"]]
+    return {**search, "results": results}
+
+
+@app.on_event("shutdown")
+async def _close_enrich_clients():
+    for client in list(_enrich_clients.values()):
+        with contextlib.suppress(Exception):
+            await client.aclose()
+    _enrich_clients.clear()
+
+
+def _estimate_tokens(text: str) -> int:
+    # ~4 characters per token for English prose and code; close enough for budgeting
+    return (len(text) + 3) // 4
+
+
+def _allocate_tokens(budget: int, demands: dict[str, int], weights: dict[str, float]) -> dict[str, int]:
+    # Weighted water-filling: split the budget by weight, then hand what small sections don't use to the others
+    alloc = {name: 0 for name in demands}
+    active = {name for name, need in demands.items() if need > 0}
+    remaining = max(0, budget)
+    while remaining > 0 and active:
+        total_weight = sum(weights.get(name, 1.0) for name in active)
+        spent = 0
+        for name in list(active):
+            share = max(1, int(remaining * weights.get(name, 1.0) / total_weight))
+            give = min(demands[name] - alloc[name], share, remaining - spent)
+            alloc[name] += give
+            spent += give
+            if alloc[name] >= demands[name]:
+                active.discard(name)
+        if spent == 0:
+            break
+        remaining -= spent
+    return alloc
+
+
+# Coarsest first: page, paragraph (also separates search results), line, sentence, word
+_TEXT_BOUNDARIES = ("\f", "\n\n", "\n", ". ", " ")
+
+
+def _truncate_to_tokens(text: str, max_tokens: int, boundaries: tuple = _TEXT_BOUNDARIES) -> str:
+    if _estimate_tokens(text) <= max_tokens:
+        return text
+    if max_tokens <= 0:
+        return ""
+    for i, sep in enumerate(boundaries):
+        pieces = text.split(sep)
+        if len(pieces) < 2:
+            continue
+        kept, used = [], 0
+        for piece in pieces:
+            cost = _estimate_tokens(piece + sep)
+            if used + cost > max_tokens:
+                break
+            kept.append(piece)
+            used += cost
+        # Fill what's left from the next piece, cut at a finer boundary
+        tail = _truncate_to_tokens(pieces[len(kept)], max_tokens - used, boundaries[i + 1:]) if len(kept) < len(pieces) else ""
+        return sep.join(kept + [tail]) if tail else sep.join(kept)
+    return text[: max_tokens * 4]
+
+
+def _fit_whole(pieces: list[str], max_tokens: int, sep: str) -> list[str]:
+    # Longest prefix of whole pieces that fits; never a partial piece
+    kept, used = [], 0
+    for piece in pieces:
+        cost = _estimate_tokens(piece + sep)
+        if used + cost > max_tokens:
+            break
+        kept.append(piece)
+        used += cost
+    return kept
+
+
+def _truncate_whole(text: str, max_tokens: int, boundaries: tuple = ("\f", "\n\n", "\n")) -> str:
+    # Whole pages if at least one fits, else whole paragraphs, else whole lines of the first page; "" rather than a fragment
+    if _estimate_tokens(text) <= max_tokens:
+        return text
+    for sep in boundaries:
+        kept = _fit_whole(text.split(sep), max_tokens, sep)
+        if kept:
+            return sep.join(kept)
+        text = text.split(sep, 1)[0]
+    return ""
+
+
+# Sent once as the model's system instruction, not per request
+SYSTEM_PROMPT = (
+    "You are a helpful coding assistant. Always respond in Markdown.\n"
+    "- When including code, use fenced code blocks with the correct language tag (e.g., ```python, ```html).\n"
+    "- For multi-line code, never inline it; use fenced blocks only.\n"
+    "- Keep prose concise; if code is primary, start with a short title then the code block.\n"
+    "- Do not wrap code in a single paragraph.\n"
+)
+
+
+def _fit_recent(segments: list[str], max_tokens: int) -> str:
+    # Keep the newest history segments that fit; the summary (oldest) is the first to go
+    kept, used = [], 0
+    for segment in reversed(segments):
+        cost = _estimate_tokens(segment) + 1
+        if used + cost > max_tokens:
+            if not kept:
+                kept.append(_truncate_to_tokens(segment, max_tokens))
+            break
+        kept.append(segment)
+        used += cost
+    return "\n\n".join(reversed(kept))
+
+
+class _StageGraph:
+    """Runs pre-LLM stages as soon as their dependencies finish, each under its own deadline.
+
+    A stage that fails or misses its deadline yields its default instead, so the prompt is assembled
+    from whatever finished in time. Threads behind a timed-out stage run to completion but are no
+    longer waited on.
+    """
+
+    def __init__(self):
+        self._stages: dict[str, tuple] = {}
+
+    def add(self, name: str, fn, deps: tuple[str, ...] = (), timeout: float | None = None, default=None):
+        # fn receives the results of deps, in order, and returns an awaitable
+        self._stages[name] = (fn, deps, timeout, default)
+        return self
+
+    async def run(self) -> dict:
+        results: dict[str, object] = {}
+        tasks: dict[str, asyncio.Future] = {}
+
+        async def run_stage(name: str):
+            fn, deps, timeout, default = self._stages[name]
+            for dep in deps:
+                await tasks[dep]
+            stats = _stage_stats.setdefault(name, {"runs": 0, "timeouts": 0, "errors": 0, "latency_total": 0.0})
+            started = time.monotonic()
+            try:
+                results[name] = await asyncio.wait_for(fn(*(results[dep] for dep in deps)), timeout)
+            except asyncio.TimeoutError:
+                stats["timeouts"] += 1
+                logger.warning(f"Pre-LLM stage {name} missed its {timeout}s deadline")
+                results[name] = default
+            except Exception as e:
+                stats["errors"] += 1
+                logger.error(f"Pre-LLM stage {name} failed: {e}")
+                results[name] = default
+            stats["runs"] += 1
+            stats["latency_total"] += time.monotonic() - started
+
+        for name in self._stages:
+            tasks[name] = asyncio.ensure_future(run_stage(name))
+        await asyncio.gather(*tasks.values())
+        return results
+
+
+_stage_stats: dict[str, dict] = {}
+
+
+def _decode_attachment(attachment: dict) -> dict | None:
+    # Expect a data URL like: data:<mime>;base64,<payload>
+    data_url = attachment["data"]
+    if data_url.startswith("data:") and ";base64," in data_url:
+        return {"mime_type": attachment["mime"], "data": base64.b64decode(data_url.split(",", 1)[1])}
+    return None
+
+
+async def _prepare_content_parts(query: str, attachment: dict | None, needs_search: bool, history: list[str] | None = None):
+    # Attachment decode -> OCR runs alongside the search; history is resolved by the caller, since
+    # it's part of the single-flight key
+    graph = _StageGraph()
+    if attachment and attachment.get("data") and attachment.get("mime"):
+        async def ocr(inline: dict | None) -> str:
+            if inline is None:
+                return ""
+            return await asyncio.to_thread(_try_ocr_bytes, inline["data"], inline["mime_type"]) or ""
+
+        graph.add("attachment", lambda: asyncio.to_thread(_decode_attachment, attachment), timeout=STAGE_TIMEOUT_DECODE_SECONDS)
+        graph.add("ocr", ocr, deps=("attachment",), timeout=STAGE_TIMEOUT_OCR_SECONDS, default="")
+    if needs_search:
+        graph.add(
+            "search", lambda: _search(query), timeout=STAGE_TIMEOUT_SEARCH_SECONDS,
+            default={"results": [], "error": "Search unavailable: the search took too long."},
+        )
+        if SEARCH_ENRICH_ENABLED and httpx is not None:
+            # _enrich_search enforces its own budget and keeps the pages that made it; the stage deadline is a backstop
+            graph.add("enrich", _enrich_search, deps=("search",), timeout=SEARCH_ENRICH_BUDGET_SECONDS + 1)
+    results = await graph.run()
+    search = results.get("enrich") or results.get("search")
+    return _build_content_parts(query, results.get("attachment"), results.get("ocr", ""), search, history)
+
+
+def _build_content_parts(query: str, inline_data: dict | None, ocr_text: str = "", search: dict | None = None, history: list[str] | None = None):
+    inline_part = {"inline_data": inline_data} if inline_data is not None else None
+    search_results = _format_search_results(search) if search is not None else ""
+    # Split the input budget across sections so prompt size (and latency) stays bounded
+    demands = {
+        "query": _estimate_tokens(query),
+        "search": _estimate_tokens(search_results or ""),
+        "ocr": _estimate_tokens(ocr_text),
+        "history": sum(_estimate_tokens(segment) + 1 for segment in history or []),
+    }
+    alloc = _allocate_tokens(PROMPT_TOKEN_BUDGET - _estimate_tokens(SYSTEM_PROMPT), demands, PROMPT_SECTION_WEIGHTS)
+
+    parts = []
+    if history:
+        parts.append(f"Conversation so far:\n{_fit_recent(history, alloc['history'])}\n\n")
+    parts.append(f"User query: {_truncate_to_tokens(query, alloc['query'])}")
+    if inline_part is not None:
+        parts.append(inline_part)
+        ocr_text = _truncate_whole(ocr_text, alloc["ocr"])
+        if ocr_text:
+            parts.append("\n\nThe following is text OCR'ed from the attachment (may be imperfect):\n")
+            parts.append(ocr_text)
+        parts.append("Consider the attached file when answering.")
+    if search_results:
+        search_results = _format_search_results(search, alloc["search"])
+    if search_results:
+        parts.append(f"\n\nSearch results:\n{search_results}\n\nProvide the answer now and include citations as [source: url] where relevant.")
     return parts
 
 
@@ -177,64 +820,1376 @@ def _try_ocr_bytes(data: bytes, mime: str) -> Optional[str]:
                     t = pytesseract.image_to_string(img)
                     if t:
                         text_chunks.append(t)
-            return "\n\n".join(text_chunks).strip()
+            # Form feeds mark page breaks so prompt budgeting can cut between pages
+            return "\f".join(text_chunks).strip()
     except Exception as e:
         logger.error(f"OCR error: {e}")
     return None
 
 
+DEFAULT_MODEL = "gemini-2.5-flash"
+
+# Process-wide GenerativeModel registry keyed by (model name, generation config, system instruction).
+# All models share the SDK's default gRPC clients, so each one is built once and reused across requests.
+_model_registry: dict[tuple, GenerativeModel] = {}
+_model_registry_lock = threading.Lock()
+# Input tokens Gemini served from its implicit prefix cache, in total and for the most recent requests
+_prompt_cache_stats = {"requests": 0, "prompt_tokens": 0, "cached_tokens": 0}
+_recent_prompt_usage: deque = deque(maxlen=50)
+
+
+def _get_model(model_name: str = DEFAULT_MODEL, system_instruction: str | None = None, **generation_config) -> GenerativeModel:
+    key = (model_name, tuple(sorted(generation_config.items())), system_instruction)
+    model = _model_registry.get(key)
+    if model is None:
+        with _model_registry_lock:
+            model = _model_registry.get(key)
+            if model is None:
+                model = GenerativeModel(
+                    model_name,
+                    generation_config=GenerationConfig(**generation_config),
+                    system_instruction=system_instruction,
+                )
+                _model_registry[key] = model
+    return model
+
+
+def _record_usage(response, model_name: str):
+    # SYSTEM_PROMPT (~100 tokens) is far below the minimum for an explicit CachedContent, so savings come
+    # from Gemini's implicit prefix caching, which kicks in once a request's shared prefix is long enough
+    # (e.g. a long conversation or attachment resent across turns)
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    prompt_tokens = getattr(usage, "prompt_token_count", 0) or 0
+    cached_tokens = getattr(usage, "cached_content_token_count", 0) or 0
+    _prompt_cache_stats["requests"] += 1
+    _prompt_cache_stats["prompt_tokens"] += prompt_tokens
+    _prompt_cache_stats["cached_tokens"] += cached_tokens
+    _recent_prompt_usage.append({"model": model_name, "prompt_tokens": prompt_tokens, "cached_tokens": cached_tokens})
+    logger.info(f"{model_name} prompt tokens: {prompt_tokens}, saved by prompt cache: {cached_tokens}")
+
+
+@app.on_event("startup")
+async def _warm_search_client():
+    if GOOGLE_API_KEY and GOOGLE_CSE_ID:
+        try:
+            await asyncio.to_thread(_get_search_service)
+        except Exception as e:
+            logger.warning(f"Search client warm-up failed: {e}")
+
+
+@app.on_event("startup")
+async def _warm_models():
+    # Build the models used by chat and suggestions, and open the shared gRPC channels,
+    # so the first request doesn't pay for client setup before its first token
+    if LLM_PROVIDER != "gemini":
+        return
+    try:
+        for name in dict.fromkeys([DEFAULT_MODEL, *MODEL_TIERS.values(), *GEMINI_FALLBACK_MODELS]):
+            for max_tokens in {rule.get("max_output_tokens") for rule in ROUTING_RULES}:
+                _get_model(name, SYSTEM_PROMPT, temperature=0.7, **({"max_output_tokens": int(max_tokens)} if max_tokens else {}))
+            _get_model(name, temperature=0.3)
+        genai_client.get_default_generative_client()
+        genai_client.get_default_generative_async_client()
+        logger.info(f"Warmed {len(_model_registry)} Gemini model(s)")
+    except Exception as e:
+        logger.error(f"Model warm-up error: {e}")
+
+
+class _GeminiProvider:
+    """Google Gemini via google.generativeai, using the shared model registry."""
+
+    name = "gemini"
+
+    async def generate(self, contents, model_name: str, system_instruction: str | None = None, **generation_config):
+        return await _get_model(model_name, system_instruction, **generation_config).generate_content_async(contents)
+
+    async def stream(self, contents, model_name: str, system_instruction: str | None = None, **generation_config):
+        response = await _get_model(model_name, system_instruction, **generation_config).generate_content_async(contents, stream=True)
+        async for chunk in response:
+            yield chunk
+
+
+class _FakeChunk:
+    def __init__(self, text: str):
+        self.text = text
+        self.usage_metadata = None
+
+
+class _FakeProvider:
+    """Offline provider for load tests and benchmarks.
+
+    Text is derived from the prompt (or FAKE_LLM_RESPONSE), timing follows the configured
+    time-to-first-token and inter-chunk delay, and errors are injected from a seeded RNG,
+    so runs are reproducible without touching quota.
+    """
+
+    name = "fake"
+
+    def __init__(self, ttft: float, chunk_delay: float, chunks: int, error_rate: float, canned: str, seed: int):
+        self.ttft = ttft
+        self.chunk_delay = chunk_delay
+        self.chunks = max(1, chunks)
+        self.error_rate = error_rate
+        self.canned = canned
+        self._rng = random.Random(seed)
+
+    def _maybe_fail(self):
+        if self.error_rate and self._rng.random() < self.error_rate:
+            raise google_exceptions.ServiceUnavailable("Injected fake provider error")
+
+    def _text(self, contents) -> str:
+        prompt = contents if isinstance(contents, str) else "\n".join(p for p in contents if isinstance(p, str))
+        batch = re.search(r"JSON array of arrays with exactly (\d+) elements", prompt)
+        if batch:
+            return json.dumps([["Explain this in more detail", f"Show an example for response {i + 1}"] for i in range(int(batch.group(1)))])
+        if "JSON array" in prompt:
+            return json.dumps(["Explain this in more detail", "Show an example", "Add unit tests"])
+        if self.canned:
+            return self.canned
+        digest = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+        sentences = [f"Simulated answer {digest[:8]}, part {i + 1}. " for i in range(self.chunks)]
+        return "".join(sentences)
+
+    def _pieces(self, text: str) -> list[str]:
+        size = max(1, -(-len(text) // self.chunks))
+        return [text[i:i + size] for i in range(0, len(text), size)]
+
+    async def generate(self, contents, model_name: str, system_instruction: str | None = None, **generation_config):
+        await asyncio.sleep(self.ttft + self.chunk_delay * (self.chunks - 1))
+        self._maybe_fail()
+        return _FakeChunk(self._text(contents))
+
+    async def stream(self, contents, model_name: str, system_instruction: str | None = None, **generation_config):
+        await asyncio.sleep(self.ttft)
+        self._maybe_fail()
+        for i, piece in enumerate(self._pieces(self._text(contents))):
+            if i:
+                await asyncio.sleep(self.chunk_delay)
+            yield _FakeChunk(piece)
+
+
+def _make_provider():
+    if LLM_PROVIDER == "fake":
+        logger.warning("Using the fake LLM provider; responses are simulated")
+        return _FakeProvider(
+            FAKE_LLM_TTFT_SECONDS,
+            FAKE_LLM_CHUNK_DELAY_SECONDS,
+            FAKE_LLM_CHUNKS,
+            FAKE_LLM_ERROR_RATE,
+            FAKE_LLM_RESPONSE,
+            FAKE_LLM_SEED,
+        )
+    return _GeminiProvider()
+
+
+_provider = _make_provider()
+
+
+class _TTLCache:
+    """Thread-safe LRU cache with a per-entry TTL and an approximate memory budget."""
+
+    def __init__(self, max_entries: int, max_bytes: int):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self._data: OrderedDict[str, tuple[float, int, object]] = OrderedDict()
+        self._lock = threading.Lock()
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, size, value = entry
+            if expires_at <= time.monotonic():
+                del self._data[key]
+                self.bytes -= size
+                self.misses += 1
+                return None
+            self._data.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def set(self, key: str, value, ttl: float, size: int | None = None):
+        if size is None:
+            size = len(value.encode("utf-8")) if isinstance(value, str) else len(str(value))
+        if ttl <= 0 or size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._data.pop(key, None)
+            if old is not None:
+                self.bytes -= old[1]
+            self._data[key] = (time.monotonic() + ttl, size, value)
+            self.bytes += size
+            while self._data and (len(self._data) > self.max_entries or self.bytes > self.max_bytes):
+                _, (_, evicted_size, _) = self._data.popitem(last=False)
+                self.bytes -= evicted_size
+                self.evictions += 1
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.misses
+        return {
+            "entries": len(self._data),
+            "bytes": self.bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": round(self.hits / lookups, 4) if lookups else 0.0,
+        }
+
+
+_response_cache = _TTLCache(RESPONSE_CACHE_MAX_ENTRIES, RESPONSE_CACHE_MAX_BYTES)
+_search_cache = _TTLCache(SEARCH_CACHE_MAX_ENTRIES, SEARCH_CACHE_MAX_BYTES)
+_page_text_cache = _TTLCache(SEARCH_CACHE_MAX_ENTRIES, SEARCH_CACHE_MAX_BYTES)
+
+
+def _normalize_prompt(query: str) -> str:
+    return " ".join((query or "").split()).casefold()
+
+
+# Uploads up to this size are hashed inline (well under a millisecond); larger ones on a worker thread
+_ATTACHMENT_DIGEST_INLINE_BYTES = 256 * 1024
+
+
+def _attachment_digest(attachment: dict | None) -> str:
+    # The data URL is hashed as sent: same bytes, same base64, and no decode pass over a multi-MB payload
+    if not attachment or not attachment.get("data"):
+        return ""
+    return hashlib.sha256(attachment["data"].encode("utf-8")).hexdigest()
+
+
+async def _request_key(query: str, attachment: dict | None, history: list[str] | None = None) -> str:
+    # Normalized prompt plus a SHA-256 of the attachment identifies an answer;
+    # conversation history is part of the key so different sessions never share one
+    if attachment and len(attachment.get("data") or "") > _ATTACHMENT_DIGEST_INLINE_BYTES:
+        # Hashing a large upload takes tens of milliseconds; hashlib releases the GIL, so a thread really helps
+        digest = await asyncio.to_thread(_attachment_digest, attachment)
+    else:
+        digest = _attachment_digest(attachment)
+    key = f"{_normalize_prompt(query)}\x00{digest}"
+    if history:
+        key += "\x00" + "\x00".join(history)
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+# Priority classes for Gemini admission; lower values are served first
+PRIORITY_INTERACTIVE = 0
+PRIORITY_CHAT = 1
+PRIORITY_BACKGROUND = 2
+
+
+class _Overloaded(Exception):
+    def __init__(self, retry_after: int):
+        super().__init__(f"Model capacity exhausted; retry after {retry_after}s")
+        self.retry_after = retry_after
+
+
+class _UpstreamUnavailable(Exception):
+    """The model call failed after retries and fallbacks; surfaced as a 503 or a stream error, never as answer text."""
+
+    def __init__(self, message: str, retry_after: int | None = None):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+def _is_overload_error(e: BaseException) -> bool:
+    return isinstance(e, (google_exceptions.ResourceExhausted, google_exceptions.ServiceUnavailable, google_exceptions.DeadlineExceeded))
+
+
+class _Permit:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.first_output_at: float | None = None
+        self.overloaded = False
+
+    def observe(self):
+        # Streams report their first chunk so latency means time-to-first-token, not generation length
+        if self.first_output_at is None:
+            self.first_output_at = time.monotonic()
+
+    def latency(self) -> float:
+        return (self.first_output_at or time.monotonic()) - self.started
+
+
+class _AdaptiveLimiter:
+    """AIMD concurrency limit for Gemini calls with a bounded priority queue; rejects fast when the queue is full."""
+
+    def __init__(self, initial: int, min_limit: int, max_limit: int, max_queue: int, target_latency: float):
+        self.min_limit = max(1, min_limit)
+        self.max_limit = max(self.min_limit, max_limit)
+        self.limit = float(min(max(initial, self.min_limit), self.max_limit))
+        self.max_queue = max_queue
+        self.target_latency = target_latency
+        self.in_flight = 0
+        self.avg_latency = 0.0
+        self.admitted = 0
+        self.rejected = 0
+        self.decreases = 0
+        self._last_decrease = 0.0
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+
+    async def acquire(self, priority: int):
+        if self.in_flight < int(self.limit) and not self._waiters:
+            self.in_flight += 1
+            self.admitted += 1
+            return
+        if len(self._waiters) >= self.max_queue:
+            self.rejected += 1
+            raise _Overloaded(self._retry_after())
+        fut = asyncio.get_running_loop().create_future()
+        entry = (priority, next(self._seq), fut)
+        heapq.heappush(self._waiters, entry)
+        try:
+            await fut
+        except asyncio.CancelledError:
+            if fut.done() and not fut.cancelled():
+                # Granted just as we were cancelled; hand the slot on
+                self._release_slot()
+            elif entry in self._waiters:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+            raise
+        self.admitted += 1
+
+    def release(self, latency: float, overloaded: bool):
+        self.avg_latency = latency if not self.avg_latency else 0.8 * self.avg_latency + 0.2 * latency
+        now = time.monotonic()
+        if overloaded or latency > self.target_latency:
+            # Multiplicative decrease, at most once per target-latency window
+            if now - self._last_decrease > self.target_latency:
+                self.limit = max(self.min_limit, self.limit / 2)
+                self._last_decrease = now
+                self.decreases += 1
+        elif self.in_flight >= int(self.limit):
+            # Additive increase, only while the limit is what's holding calls back
+            self.limit = min(self.max_limit, self.limit + 1 / self.limit)
+        self._release_slot()
+
+    def _release_slot(self):
+        self.in_flight -= 1
+        while self._waiters and self.in_flight < int(self.limit):
+            _, _, fut = heapq.heappop(self._waiters)
+            if fut.done():
+                continue
+            fut.set_result(None)
+            self.in_flight += 1
+
+    def _retry_after(self) -> int:
+        per_call = self.avg_latency or self.target_latency / 4
+        return max(1, int(per_call * (len(self._waiters) + 1) / max(1, int(self.limit))))
+
+    @contextlib.asynccontextmanager
+    async def slot(self, priority: int):
+        await self.acquire(priority)
+        permit = _Permit()
+        try:
+            yield permit
+        except Exception as e:
+            permit.overloaded = _is_overload_error(e)
+            raise
+        finally:
+            self.release(permit.latency(), permit.overloaded)
+
+    def stats(self) -> dict:
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "queued": len(self._waiters),
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "decreases": self.decreases,
+            "avg_latency": round(self.avg_latency, 3),
+        }
+
+
+_gemini_limiter = _AdaptiveLimiter(
+    GEMINI_INITIAL_CONCURRENCY,
+    GEMINI_MIN_CONCURRENCY,
+    GEMINI_MAX_CONCURRENCY,
+    GEMINI_QUEUE_SIZE,
+    GEMINI_TARGET_LATENCY_SECONDS,
+)
+
+
+async def _overloaded_response(request, exc: _Overloaded):
+    return JSONResponse(status_code=429, content={"detail": str(exc)}, headers={"Retry-After": str(exc.retry_after)})
+
+
+app.add_exception_handler(_Overloaded, _overloaded_response)
+
+
+async def _upstream_unavailable_response(request, exc: _UpstreamUnavailable):
+    headers = {"Retry-After": str(exc.retry_after)} if exc.retry_after else None
+    return JSONResponse(status_code=503, content={"detail": str(exc)}, headers=headers)
+
+
+app.add_exception_handler(_UpstreamUnavailable, _upstream_unavailable_response)
+
+
+def _is_retryable_error(e: BaseException) -> bool:
+    return isinstance(e, (
+        google_exceptions.ResourceExhausted,
+        google_exceptions.ServiceUnavailable,
+        google_exceptions.DeadlineExceeded,
+        google_exceptions.InternalServerError,
+        google_exceptions.Aborted,
+        asyncio.TimeoutError,
+    ))
+
+
+class _CircuitBreaker:
+    """Opens after a run of consecutive failures; lets one probe through after the reset timeout."""
+
+    def __init__(self, failure_threshold: int, reset_timeout: float):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = "closed"
+        self.failures = 0
+        self.opened_at = 0.0
+        self.trips = 0
+
+    def allow(self) -> bool:
+        if self.state == "closed":
+            return True
+        # One probe per reset window; a probe that never reports back is superseded by the next window
+        if time.monotonic() - self.opened_at >= self.reset_timeout:
+            self.state = "half_open"
+            self.opened_at = time.monotonic()
+            return True
+        return False
+
+    def retry_after(self) -> int:
+        return max(1, int(self.reset_timeout - (time.monotonic() - self.opened_at)))
+
+    def record_success(self):
+        self.state = "closed"
+        self.failures = 0
+
+    def record_failure(self):
+        self.failures += 1
+        if self.state == "half_open" or self.failures >= self.failure_threshold:
+            if self.state != "open":
+                self.trips += 1
+            self.state = "open"
+            self.opened_at = time.monotonic()
+
+    def stats(self) -> dict:
+        return {"state": self.state, "consecutive_failures": self.failures, "trips": self.trips}
+
+
+_breakers: dict[str, _CircuitBreaker] = {}
+_resilience_stats = {"retries": 0, "fallbacks": 0, "failures": 0}
+
+
+def _breaker(model_name: str) -> _CircuitBreaker:
+    if model_name not in _breakers:
+        _breakers[model_name] = _CircuitBreaker(GEMINI_BREAKER_FAILURES, GEMINI_BREAKER_RESET_SECONDS)
+    return _breakers[model_name]
+
+
+def _model_chain(primary: str) -> list[str]:
+    # A routed fast tier still falls back to the default model before the configured fallbacks
+    chain = [primary]
+    for name in [DEFAULT_MODEL] + GEMINI_FALLBACK_MODELS:
+        if name not in chain:
+            chain.append(name)
+    return chain
+
+
+def _backoff_delay(attempt: int) -> float:
+    # Full jitter keeps retries from many requests from landing in lockstep
+    return random.uniform(0, min(GEMINI_RETRY_MAX_SECONDS, GEMINI_RETRY_BASE_SECONDS * (2 ** attempt)))
+
+
+def _chain_exhausted(model_name: str, last_error: Exception | None) -> _UpstreamUnavailable:
+    # Retry-After only when an open breaker says when the next probe is due
+    waits = [_breaker(name).retry_after() for name in _model_chain(model_name) if _breaker(name).state != "closed"]
+    retry_after = min(waits) if waits else None
+    if last_error is None:
+        return _UpstreamUnavailable("Model unavailable: every model in the fallback chain is failing", retry_after)
+    return _UpstreamUnavailable(f"Model unavailable: {last_error}", retry_after)
+
+
+async def _generate_with_resilience(contents, priority: int, model_name: str = DEFAULT_MODEL, system_instruction: str | None = None, **generation_config):
+    """Non-streaming Gemini call with jittered retries, per-model circuit breakers and the fallback chain."""
+    last_error: Exception | None = None
+    for index, name in enumerate(_model_chain(model_name)):
+        breaker = _breaker(name)
+        if not breaker.allow():
+            continue
+        if index > 0:
+            _resilience_stats["fallbacks"] += 1
+        for attempt in range(GEMINI_MAX_RETRIES + 1):
+            try:
+                async with _gemini_limiter.slot(priority):
+                    response = await _provider.generate(contents, name, system_instruction, **generation_config)
+                breaker.record_success()
+                _record_usage(response, name)
+                return response
+            except _Overloaded:
+                raise
+            except Exception as e:
+                if not _is_retryable_error(e):
+                    # The model answered, just not successfully; that's not an availability problem
+                    breaker.record_success()
+                    raise
+                last_error = e
+                breaker.record_failure()
+                _resilience_stats["failures"] += 1
+                # Quota errors won't clear within a retry window; move straight to the next model
+                if isinstance(e, google_exceptions.ResourceExhausted) or attempt == GEMINI_MAX_RETRIES or not breaker.allow():
+                    logger.warning(f"Gemini {name} failed ({e}); trying next model")
+                    break
+                _resilience_stats["retries"] += 1
+                await asyncio.sleep(_backoff_delay(attempt))
+    raise _chain_exhausted(model_name, last_error) from last_error
+
+
+async def _stream_with_resilience(contents, priority: int, model_name: str = DEFAULT_MODEL, system_instruction: str | None = None, **generation_config):
+    """Streaming variant; only retries or falls back before the first chunk has been yielded."""
+    last_error: Exception | None = None
+    for index, name in enumerate(_model_chain(model_name)):
+        breaker = _breaker(name)
+        if not breaker.allow():
+            continue
+        if index > 0:
+            _resilience_stats["fallbacks"] += 1
+        for attempt in range(GEMINI_MAX_RETRIES + 1):
+            started = False
+            try:
+                async with _gemini_limiter.slot(priority) as permit:
+                    # Async stream: each chunk is awaited, so other sockets keep being served
+                    last_chunk = None
+                    async for chunk in _provider.stream(contents, name, system_instruction, **generation_config):
+                        permit.observe()
+                        started = True
+                        last_chunk = chunk
+                        yield chunk
+                breaker.record_success()
+                _record_usage(last_chunk, name)
+                return
+            except _Overloaded:
+                raise
+            except Exception as e:
+                if started or not _is_retryable_error(e):
+                    # Part of the answer is already with the client; a retry would duplicate it
+                    if not _is_retryable_error(e):
+                        breaker.record_success()
+                    else:
+                        breaker.record_failure()
+                    raise
+                last_error = e
+                breaker.record_failure()
+                _resilience_stats["failures"] += 1
+                if isinstance(e, google_exceptions.ResourceExhausted) or attempt == GEMINI_MAX_RETRIES or not breaker.allow():
+                    logger.warning(f"Gemini {name} stream failed ({e}); trying next model")
+                    break
+                _resilience_stats["retries"] += 1
+                await asyncio.sleep(_backoff_delay(attempt))
+    raise _chain_exhausted(model_name, last_error) from last_error
+
+
+class _Hedger:
+    """Sends a duplicate call when the first is slower than a recent-latency percentile; first finisher wins.
+
+    Hedges per request class are capped at a fraction of that class's requests, so upstream spend
+    grows by at most the budget.
+    """
+
+    def __init__(self, enabled: bool, percentile: float, budget: float, min_samples: int, window: int = 200):
+        self.enabled = enabled
+        self.percentile = percentile
+        self.budget = budget
+        self.min_samples = min_samples
+        self.window = window
+        self._classes: dict[str, dict] = {}
+
+    def _class(self, request_class: str) -> dict:
+        if request_class not in self._classes:
+            self._classes[request_class] = {"latencies": deque(maxlen=self.window), "requests": 0, "hedges": 0, "hedge_wins": 0}
+        return self._classes[request_class]
+
+    def _delay(self, state: dict) -> float | None:
+        latencies = state["latencies"]
+        if len(latencies) < self.min_samples:
+            return None
+        ordered = sorted(latencies)
+        return ordered[int(self.percentile / 100 * (len(ordered) - 1))]
+
+    async def _timed(self, state: dict, make_call):
+        started = time.monotonic()
+        result = await make_call()
+        state["latencies"].append(time.monotonic() - started)
+        return result
+
+    async def run(self, request_class: str, make_call):
+        state = self._class(request_class)
+        state["requests"] += 1
+        primary = asyncio.ensure_future(self._timed(state, make_call))
+        delay = self._delay(state) if self.enabled else None
+        if delay is None:
+            return await primary
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done or state["hedges"] + 1 > self.budget * state["requests"]:
+            return await primary
+
+        state["hedges"] += 1
+        hedge = asyncio.ensure_future(self._timed(state, make_call))
+        pending = {primary, hedge}
+        error: BaseException | None = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            state["hedge_wins"] += 1
+                        return task.result()
+                    error = task.exception()
+            raise error
+        finally:
+            # Cancel the loser (or both, if our caller went away)
+            for task in pending:
+                task.cancel()
+
+    def stats(self) -> dict:
+        out = {}
+        for name, state in self._classes.items():
+            delay = self._delay(state)
+            out[name] = {
+                "requests": state["requests"],
+                "hedges": state["hedges"],
+                "hedge_wins": state["hedge_wins"],
+                "hedge_win_rate": round(state["hedge_wins"] / state["hedges"], 4) if state["hedges"] else 0.0,
+                "hedge_delay": round(delay, 3) if delay is not None else None,
+            }
+        return {"enabled": self.enabled, "classes": out}
+
+
+_hedger = _Hedger(GEMINI_HEDGE_ENABLED, GEMINI_HEDGE_PERCENTILE, GEMINI_HEDGE_BUDGET, GEMINI_HEDGE_MIN_SAMPLES)
+
+
+def _load_routing_config():
+    global MODEL_TIERS, ROUTING_RULES
+    try:
+        if os.getenv("MODEL_TIERS"):
+            MODEL_TIERS = {**MODEL_TIERS, **json.loads(os.environ["MODEL_TIERS"])}
+        if os.getenv("ROUTING_RULES_FILE"):
+            with open(os.environ["ROUTING_RULES_FILE"], "r", encoding="utf-8") as f:
+                ROUTING_RULES = json.load(f)
+        elif os.getenv("ROUTING_RULES"):
+            ROUTING_RULES = json.loads(os.environ["ROUTING_RULES"])
+    except Exception as e:
+        logger.error(f"Invalid routing config, using defaults: {e}")
+
+
+_load_routing_config()
+
+_CODE_HINT_RE = re.compile(
+    r"```|\b(def|class|function|import|return|const|let|var|public|async|SELECT)\b|"
+    r"\b(code|bug|error|traceback|exception|stack trace|refactor|implement|compile|regex|sql)\b",
+    re.IGNORECASE,
+)
+_routing_stats: dict[str, dict] = {}
+
+
+def _routing_features(query: str, attachment: dict | None, needs_search: bool, history: list[str] | None = None) -> dict:
+    data = (attachment or {}).get("data") or ""
+    return {
+        "prompt_chars": len(query or ""),
+        "history_chars": sum(len(segment) for segment in history or []),
+        "has_attachment": bool(data),
+        "attachment_mime": (attachment or {}).get("mime") or "",
+        # Base64 inflates by 4/3; close enough without decoding
+        "attachment_bytes": len(data) * 3 // 4,
+        "needs_search": needs_search,
+        # A follow-up in a code conversation is a code question even when the prompt itself has no code in it
+        "code_hint": any(_CODE_HINT_RE.search(text) for text in [query or "", *(history or [])]),
+    }
+
+
+def _rule_matches(when: dict, f: dict) -> bool:
+    checks = {
+        "has_attachment": lambda v: f["has_attachment"] == v,
+        "attachment_mime_prefix": lambda v: f["attachment_mime"].startswith(v),
+        "min_attachment_bytes": lambda v: f["attachment_bytes"] >= v,
+        "max_attachment_bytes": lambda v: f["attachment_bytes"] <= v,
+        "needs_search": lambda v: f["needs_search"] == v,
+        "code_hint": lambda v: f["code_hint"] == v,
+        "min_prompt_chars": lambda v: f["prompt_chars"] >= v,
+        "max_prompt_chars": lambda v: f["prompt_chars"] <= v,
+        "min_history_chars": lambda v: f["history_chars"] >= v,
+        "max_history_chars": lambda v: f["history_chars"] <= v,
+    }
+    return all(name in checks and checks[name](value) for name, value in when.items())
+
+
+def _route(query: str, attachment: dict | None, needs_search: bool, history: list[str] | None = None) -> dict:
+    """Pick a model tier and output cap from cheap request features; first matching rule wins."""
+    features = _routing_features(query, attachment, needs_search, history)
+    for index, rule in enumerate(ROUTING_RULES):
+        if _rule_matches(rule.get("when") or {}, features):
+            tier = rule.get("tier", "standard")
+            return {
+                "rule": index,
+                "tier": tier,
+                "model": MODEL_TIERS.get(tier, DEFAULT_MODEL),
+                "max_output_tokens": int(rule["max_output_tokens"]) if rule.get("max_output_tokens") else None,
+                "features": features,
+                "started": time.monotonic(),
+            }
+    return {"rule": None, "tier": "standard", "model": DEFAULT_MODEL, "max_output_tokens": None, "features": features, "started": time.monotonic()}
+
+
+def _output_cap(route: dict) -> dict:
+    # Generation config kwargs for the route's cap; uncapped routes leave max_output_tokens unset
+    return {"max_output_tokens": route["max_output_tokens"]} if route["max_output_tokens"] else {}
+
+
+def _record_route(route: dict, ok: bool):
+    latency = time.monotonic() - route["started"]
+    tier = _routing_stats.setdefault(route["tier"], {"requests": 0, "errors": 0, "latency_total": 0.0})
+    tier["requests"] += 1
+    tier["errors"] += 0 if ok else 1
+    tier["latency_total"] += latency
+    logger.info(
+        f"route tier={route['tier']} model={route['model']} rule={route['rule']} "
+        f"max_output_tokens={route['max_output_tokens']} features={route['features']} latency={latency:.3f}s ok={ok}"
+    )
+
+
+_LEGACY_SEARCH_KEYWORDS = ["what is", "latest", "news", "find", "search"]
+_SEARCH_INTENT_WEIGHTS = {
+    # Freshness and lookups the model can't answer from training data
+    "latest": 2.5, "news": 2.5, "today": 2.0, "tonight": 2.0, "yesterday": 2.0, "this week": 2.0,
+    "current": 1.5, "currently": 1.5, "recent": 1.5, "right now": 2.0, "<year>": 2.0,
+    "price": 2.2, "stock": 2.0, "weather": 2.5, "forecast": 2.0, "score": 1.5, "who won": 2.5,
+    "release": 1.2, "released": 1.5, "announced": 2.0, "schedule": 1.2, "near me": 2.5,
+    "search": 1.2, "search for": 2.5, "look up": 2.5, "google": 2.0, "find": 0.8, "sources": 1.0,
+    "who is": 1.2, "when is": 1.2, "where is": 1.0, "what is": 0.6, "how much": 0.8, "version": 0.8,
+    # Tasks about the user's own text or code
+    "<code>": -3.0, "code": -1.5, "bug": -1.5, "error": -1.2, "wrong": -1.5, "fix": -1.2, "function": -1.2,
+    "explain": -1.2, "write": -1.5, "rewrite": -1.5, "translate": -1.5, "summarize": -1.0, "my": -0.8,
+    "this": -0.4, "difference between": -0.8, "<math>": -1.5,
+}
+_SEARCH_INTENT_BIAS = -2.0
+_YEAR_RE = re.compile(r"^20\d\d$")
+_MATH_RE = re.compile(r"\d\s*[-+*/^=]\s*\d")
+_search_intent_stats = {"searched": 0, "skipped": 0, "agree": 0, "legacy_only": 0, "classifier_only": 0}
+
+
+class _SearchIntentClassifier:
+    """Logistic model over word unigrams, bigrams and a few shape features; scores in microseconds.
+
+    Anything with a score(query) -> float in [0, 1] can stand in for it as _search_intent.
+    """
+
+    def __init__(self, weights: dict[str, float], bias: float, threshold: float):
+        self.weights = weights
+        self.bias = bias
+        self.threshold = threshold
+
+    @classmethod
+    def from_file(cls, path: str, threshold: float):
+        with open(path, "r", encoding="utf-8") as f:
+            model = json.load(f)
+        return cls(model["weights"], float(model.get("bias", 0.0)), float(model.get("threshold", threshold)))
+
+    def features(self, query: str) -> list[str]:
+        words = re.findall(r"[a-z0-9']+", query.lower())
+        feats = words + [f"{a} {b}" for a, b in zip(words, words[1:])]
+        if any(_YEAR_RE.match(w) for w in words):
+            feats.append("<year>")
+        if _CODE_HINT_RE.search(query) and ("```" in query or "\n" in query.strip()):
+            feats.append("<code>")
+        if _MATH_RE.search(query):
+            feats.append("<math>")
+        return feats
+
+    def score(self, query: str) -> float:
+        z = self.bias + sum(self.weights.get(f, 0.0) for f in self.features(query))
+        return 1.0 / (1.0 + math.exp(-z))
+
+
+def _load_search_intent_classifier():
+    if SEARCH_INTENT_MODEL_FILE:
+        try:
+            return _SearchIntentClassifier.from_file(SEARCH_INTENT_MODEL_FILE, SEARCH_INTENT_THRESHOLD)
+        except Exception as e:
+            logger.error(f"Invalid search intent model {SEARCH_INTENT_MODEL_FILE}, using built-in weights: {e}")
+    return _SearchIntentClassifier(_SEARCH_INTENT_WEIGHTS, _SEARCH_INTENT_BIAS, SEARCH_INTENT_THRESHOLD)
+
+
+_search_intent = _load_search_intent_classifier()
+
+
+def _needs_search(query: str) -> bool:
+    score = _search_intent.score(query)
+    threshold = getattr(_search_intent, "threshold", SEARCH_INTENT_THRESHOLD)
+    decision = score >= threshold
+    _search_intent_stats["searched" if decision else "skipped"] += 1
+    if SEARCH_INTENT_SHADOW:
+        legacy = any(keyword in query.lower() for keyword in _LEGACY_SEARCH_KEYWORDS)
+        outcome = "agree" if legacy == decision else ("legacy_only" if legacy else "classifier_only")
+        _search_intent_stats[outcome] += 1
+        logger.info(f"search intent score={score:.3f} threshold={threshold} search={decision} legacy={legacy} ({outcome})")
+    return decision
+
+
 # Helper function for non-streaming query processing
-async def process_query_non_streaming(query: str, attachment: dict | None = None):
-    search_keywords = ["what is", "latest", "news", "find", "search"]
-    needs_search = any(keyword in query.lower() for keyword in search_keywords)
+_CACHE_MODES = ("default", "refresh", "bypass")
 
-    base_parts = _build_content_parts(query, attachment)
-    if needs_search:
-        search_results = perform_search(query)
-        base_parts.append(f"\n\nSearch results:\n{search_results}\n\nProvide the answer now and include citations as [source: url] where relevant.")
 
+async def process_query_non_streaming(query: str, attachment: dict | None = None, cache: str = "default"):
+    # cache: "default" reads and writes the response cache, "refresh" skips the read, "bypass" skips both
+    if cache not in _CACHE_MODES:
+        raise HTTPException(status_code=400, detail=f"Invalid cache mode {cache!r}; expected one of: {', '.join(_CACHE_MODES)}")
+    cache_key = await _request_key(query, attachment)
+    if cache == "default":
+        cached = _response_cache.get(cache_key)
+        if cached is not None:
+            return cached
+    if cache == "bypass":
+        return await _answer_query(query, attachment, cache_key, cache)
+
+    # Single-flight: identical concurrent requests share one search + Gemini call
+    task = _inflight_answers.get(cache_key)
+    if task is None:
+        task = asyncio.ensure_future(_answer_query(query, attachment, cache_key, cache))
+        _inflight_answers[cache_key] = task
+        task.add_done_callback(lambda _: _inflight_answers.pop(cache_key, None))
+        _singleflight_stats["leaders"] += 1
+    else:
+        _singleflight_stats["joined"] += 1
+    # Shield so a caller that goes away doesn't cancel the answer for everyone else
+    return await asyncio.shield(task)
+
+
+async def _answer_query(query: str, attachment: dict | None, cache_key: str, cache: str):
+    needs_search = _needs_search(query)
+
+    # OCR, search and the Gemini call all block; keep them off the event loop
+    base_parts = await _prepare_content_parts(query, attachment, needs_search)
+
+    route = _route(query, attachment, needs_search)
     try:
-        model = GenerativeModel("gemini-2.5-flash", generation_config=GenerationConfig(temperature=0.7))
-        response = model.generate_content(base_parts)
+        response = await _hedger.run("chat", lambda: _generate_with_resilience(
+            base_parts, PRIORITY_CHAT, route["model"], SYSTEM_PROMPT, temperature=0.7, **_output_cap(route)
+        ))
+        _record_route(route, ok=True)
         if not response.text:
             logger.warning(f"Empty response for query: {query}")
             return "Sorry, I couldn't generate a response. Please try again."
+        if cache != "bypass":
+            # Search-augmented answers go stale with the search results, so they expire sooner
+            ttl = RESPONSE_CACHE_SEARCH_TTL_SECONDS if needs_search else RESPONSE_CACHE_TTL_SECONDS
+            _response_cache.set(cache_key, response.text, ttl)
         return response.text
+    except (_Overloaded, _UpstreamUnavailable) as e:
+        _record_route(route, ok=False)
+        logger.error(f"Gemini API error: {e}")
+        raise
     except Exception as e:
+        _record_route(route, ok=False)
         logger.error(f"Gemini API error: {e}")
-        return f"Error processing query: {str(e)}"
+        raise _UpstreamUnavailable(f"Model call failed: {e}") from e
+
+class _SharedStream:
+    """Fans one upstream chunk stream out to many subscribers; late joiners replay the chunks so far, then follow live."""
+
+    def __init__(self, source):
+        self.chunks: list[str] = []
+        self.done = False
+        self.abandoned = False  # cancelled for lack of subscribers; new requests must start their own stream
+        self.error: Exception | None = None
+        self.subscribers = 0
+        self._changed = asyncio.Condition()
+        self.task = asyncio.ensure_future(self._pump(source))
+
+    async def _pump(self, source):
+        try:
+            async for chunk in source:
+                async with self._changed:
+                    self.chunks.append(chunk)
+                    self._changed.notify_all()
+        except Exception as e:
+            # Every subscriber re-raises it once it has replayed the chunks that came before
+            self.error = e
+        except asyncio.CancelledError:
+            # A cut-off answer must never look complete to anyone still attached
+            self.error = _UpstreamUnavailable("The answer stream was cancelled.")
+            raise
+        finally:
+            # Close the source promptly on cancellation so its Gemini slot is released now, not at GC
+            await source.aclose()
+            self.done = True
+            async with self._changed:
+                self._changed.notify_all()
+
+    async def subscribe(self):
+        self.subscribers += 1
+        sent = 0
+        try:
+            while True:
+                async with self._changed:
+                    while sent >= len(self.chunks) and not self.done:
+                        await self._changed.wait()
+                    pending = self.chunks[sent:]
+                if not pending:
+                    if self.error is not None:
+                        raise self.error
+                    return
+                sent += len(pending)
+                for chunk in pending:
+                    yield chunk
+        finally:
+            self.subscribers -= 1
+            # Nobody is listening any more; stop pulling the upstream stream
+            if self.subscribers == 0 and not self.done:
+                self.abandoned = True
+                self.task.cancel()
+
+
+_inflight_answers: dict[str, asyncio.Future] = {}
+_inflight_streams: dict[str, _SharedStream] = {}
+_singleflight_stats = {"leaders": 0, "joined": 0, "stream_leaders": 0, "stream_joined": 0}
+
 
 # Helper function for streaming query processing
-async def process_query_streaming(query: str, attachment: dict | None = None):
-    search_keywords = ["what is", "latest", "news", "find", "search"]
-    needs_search = any(keyword in query.lower() for keyword in search_keywords)
+async def process_query_streaming(query: str, attachment: dict | None = None, history: list[str] | None = None):
+    key = await _request_key(query, attachment, history)
+    shared = _inflight_streams.get(key)
+    if shared is None or shared.done or shared.abandoned:
+        shared = _SharedStream(_stream_answer(query, attachment, history))
+        _inflight_streams[key] = shared
 
-    base_parts = _build_content_parts(query, attachment)
-    if needs_search:
-        search_results = perform_search(query)
-        base_parts.append(f"\n\nSearch results:\n{search_results}\n\nProvide the answer now and include citations as [source: url] where relevant.")
+        def _forget(_):
+            if _inflight_streams.get(key) is shared:
+                del _inflight_streams[key]
+
+        shared.task.add_done_callback(_forget)
+        _singleflight_stats["stream_leaders"] += 1
+    else:
+        _singleflight_stats["stream_joined"] += 1
+    async for chunk in shared.subscribe():
+        yield chunk
+
+
+async def _stream_answer(query: str, attachment: dict | None, history: list[str] | None = None):
+    needs_search = _needs_search(query)
+
+    base_parts = await _prepare_content_parts(query, attachment, needs_search, history)
 
+    route = _route(query, attachment, needs_search, history)
     try:
-        model = GenerativeModel("gemini-2.5-flash", generation_config=GenerationConfig(temperature=0.7))
-        stream_response = model.generate_content(base_parts, stream=True)
-        for chunk in stream_response:
+        async for chunk in _stream_with_resilience(
+            base_parts, PRIORITY_INTERACTIVE, route["model"], SYSTEM_PROMPT, temperature=0.7, **_output_cap(route)
+        ):
             if hasattr(chunk, 'text') and chunk.text:
                 yield chunk.text
             else:
                 logger.warning(f"Empty chunk for query: {query}, finish_reason: {getattr(chunk, 'finish_reason', 'unknown')}")
                 yield "Sorry, I couldn't generate a response chunk. Please try again."
+        _record_route(route, ok=True)
+    except (_Overloaded, _UpstreamUnavailable) as e:
+        # Raised rather than yielded, so consumers can tell a failure from answer text
+        _record_route(route, ok=False)
+        logger.warning(f"Gemini streaming failed: {e}")
+        raise
     except Exception as e:
+        _record_route(route, ok=False)
         logger.error(f"Gemini streaming error: {e}")
-        yield f"Error: {str(e)}"
+        raise _UpstreamUnavailable(f"Model call failed: {e}") from e
+
+
+_coalesce_stats = {"chunks_in": 0, "frames_out": 0, "bytes_out": 0}
+
+
+async def _coalesce(stream, max_bytes: int = STREAM_COALESCE_BYTES, window_ms: float = STREAM_COALESCE_WINDOW_MS):
+    """Merge small upstream chunks into fewer frames: flush on size or after a short window.
+
+    The first chunk is always passed straight through so time-to-first-token is unchanged.
+    """
+    window = window_ms / 1000
+    buffer: list[str] = []
+    size = 0
+    deadline = 0.0
+    first = True
+    pending: asyncio.Future | None = None
+    loop = asyncio.get_running_loop()
+    try:
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(stream.__anext__())
+            timeout = max(0.0, deadline - loop.time()) if buffer else None
+            # Wait on the same pending read across flushes; never cancel it just because the window closed
+            done, _ = await asyncio.wait({pending}, timeout=timeout)
+            if done:
+                task, pending = pending, None
+                try:
+                    chunk = task.result()
+                except StopAsyncIteration:
+                    break
+                except Exception:
+                    # Deliver what already arrived before surfacing the failure
+                    if buffer:
+                        frame = "".join(buffer)
+                        buffer, size = [], 0
+                        _coalesce_stats["frames_out"] += 1
+                        _coalesce_stats["bytes_out"] += len(frame.encode("utf-8"))
+                        yield frame
+                    raise
+                _coalesce_stats["chunks_in"] += 1
+                if first:
+                    first = False
+                    _coalesce_stats["frames_out"] += 1
+                    _coalesce_stats["bytes_out"] += len(chunk.encode("utf-8"))
+                    yield chunk
+                    continue
+                if not buffer:
+                    deadline = loop.time() + window
+                buffer.append(chunk)
+                size += len(chunk.encode("utf-8"))
+                if size < max_bytes:
+                    continue
+            if buffer:
+                frame = "".join(buffer)
+                buffer, size = [], 0
+                _coalesce_stats["frames_out"] += 1
+                _coalesce_stats["bytes_out"] += len(frame.encode("utf-8"))
+                yield frame
+        if buffer:
+            frame = "".join(buffer)
+            _coalesce_stats["frames_out"] += 1
+            _coalesce_stats["bytes_out"] += len(frame.encode("utf-8"))
+            yield frame
+    finally:
+        if pending is not None:
+            pending.cancel()
+            with contextlib.suppress(BaseException):
+                await pending
+        await stream.aclose()
+
+
+def _sse(event: str, data: dict) -> str:
+    return f"event: {event}\ndata: {json.dumps(data)}\n\n"
+
+
+async def _sse_chat_events(query: str, attachment: dict | None = None, with_suggestions: bool = False):
+    """Server-Sent Events for one streamed answer: `chunk` events, keep-alive comments while idle, then `end`.
+
+    With suggestions requested, `answer_end` and a `suggestions` event come before `end`, generated from
+    the answer already held here so the client needs no separate /suggestions call. A failed or rejected
+    model call ends the stream with `error` (plus `retryAfter` when known) instead, and no `end` follows.
+    """
+    stream = _coalesce(process_query_streaming(query, attachment))
+    pending: asyncio.Future | None = None
+    answer: list[str] = []
+    try:
+        # An immediate comment gets headers through proxies before the first token arrives
+        yield ": stream open\n\n"
+        while True:
+            if pending is None:
+                pending = asyncio.ensure_future(stream.__anext__())
+            done, _ = await asyncio.wait({pending}, timeout=SSE_KEEPALIVE_SECONDS)
+            if not done:
+                yield ": keep-alive\n\n"
+                continue
+            task, pending = pending, None
+            try:
+                chunk = task.result()
+            except StopAsyncIteration:
+                break
+            answer.append(chunk)
+            yield _sse("chunk", {"text": chunk})
+        if with_suggestions and answer:
+            yield _sse("answer_end", {})
+            suggestions = asyncio.ensure_future(_suggest("".join(answer)))
+            while not suggestions.done():
+                done, _ = await asyncio.wait({suggestions}, timeout=SSE_KEEPALIVE_SECONDS)
+                if not done:
+                    yield ": keep-alive\n\n"
+            yield _sse("suggestions", {"suggestions": suggestions.result()})
+        yield _sse("end", {})
+    except (_Overloaded, _UpstreamUnavailable) as e:
+        error = {"message": str(e)}
+        if e.retry_after:
+            error["retryAfter"] = e.retry_after
+        yield _sse("error", error)
+    except Exception as e:
+        logger.error(f"SSE stream error: {e}")
+        yield _sse("error", {"message": str(e)})
+    finally:
+        if pending is not None:
+            pending.cancel()
+            with contextlib.suppress(BaseException):
+                await pending
+        await stream.aclose()
+
+
+def _sse_response(events) -> StreamingResponse:
+    return StreamingResponse(
+        events,
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+def _wants_suggestions(payload: dict | None) -> bool:
+    return bool((payload or {}).get("suggestions"))
+
+
+def _wants_stream(payload: dict | None, accept: str | None) -> bool:
+    return bool((payload or {}).get("stream")) or "text/event-stream" in (accept or "")
+
+
+@app.get("/stats")
+async def stats():
+    return {
+        "provider": _provider.name,
+        "response_cache": _response_cache.stats(),
+        "search_cache": {**_search_cache.stats(), **_search_stats},
+        "suggestions_cache": {**_suggestions_cache.stats(), "mongo": dict(_suggestions_mongo_stats)},
+        "suggestions": {**_suggestion_path_stats, "batching": _suggestion_batcher.stats()},
+        "singleflight": dict(_singleflight_stats),
+        "gemini_limiter": _gemini_limiter.stats(),
+        "resilience": dict(_resilience_stats),
+        "breakers": {name: breaker.stats() for name, breaker in _breakers.items()},
+        "hedging": _hedger.stats(),
+        "stream_coalescing": {
+            **_coalesce_stats,
+            "avg_bytes_per_frame": round(_coalesce_stats["bytes_out"] / _coalesce_stats["frames_out"], 1) if _coalesce_stats["frames_out"] else 0.0,
+        },
+        "routing": {
+            tier: {**data, "avg_latency": round(data["latency_total"] / data["requests"], 3)}
+            for tier, data in _routing_stats.items()
+        },
+        "pre_llm_stages": {
+            name: {**data, "avg_latency": round(data["latency_total"] / data["runs"], 3)}
+            for name, data in _stage_stats.items()
+        },
+        "search_enrichment": {"enabled": SEARCH_ENRICH_ENABLED and httpx is not None, **_enrich_stats, "cache": _page_text_cache.stats()},
+        "search_intent": {"threshold": getattr(_search_intent, "threshold", SEARCH_INTENT_THRESHOLD), **_search_intent_stats},
+        "prompt_cache": {**_prompt_cache_stats, "recent": list(_recent_prompt_usage)},
+    }
 
 # WebSocket endpoint for realtime chat
+WS_TURN_TIMEOUT_SECONDS = float(os.getenv("WS_TURN_TIMEOUT_SECONDS", "120") or 120)
+WS_IDLE_TIMEOUT_SECONDS = float(os.getenv("WS_IDLE_TIMEOUT_SECONDS", "30") or 30)
+CONVERSATION_MAX_SESSIONS = int(os.getenv("CONVERSATION_MAX_SESSIONS", "1000") or 1000)
+CONVERSATION_RECENT_TURNS = int(os.getenv("CONVERSATION_RECENT_TURNS", "4") or 4)
+CONVERSATION_SUMMARY_TOKENS = int(os.getenv("CONVERSATION_SUMMARY_TOKENS", "400") or 400)
+
+conversations_col = db["conversations"] if db is not None else None
+
+
+def _session_signature(user_id: str | None, nonce: str) -> str:
+    return hmac.new(JWT_SECRET.encode("utf-8"), f"{user_id or ''}:{nonce}".encode("utf-8"), hashlib.sha256).hexdigest()[:32]
+
+
+def _issue_session_id(user_id: str | None) -> str:
+    # Server-issued and signed, and bound to the signed-in user when there is one, so a client can't
+    # pick or guess an id that reads someone else's history
+    nonce = secrets.token_urlsafe(18)
+    return f"{nonce}.{_session_signature(user_id, nonce)}"
+
+
+def _valid_session_id(session_id: str, user_id: str | None) -> bool:
+    nonce, _, signature = session_id.partition(".")
+    return bool(nonce and signature) and hmac.compare_digest(signature, _session_signature(user_id, nonce))
+
+
+class _ConversationStore:
+    """Server-side /ws/chat memory: a rolling summary plus the last few turns per session.
+
+    Live sessions sit in a bounded LRU; evicted ones are written to Mongo and reloaded on their next turn.
+    Turns older than CONVERSATION_RECENT_TURNS are folded into the summary in the background.
+    """
+
+    def __init__(self, max_sessions: int, collection):
+        self.max_sessions = max_sessions
+        self.collection = collection
+        self._sessions: OrderedDict[str, dict] = OrderedDict()
+        self._tasks: set[asyncio.Task] = set()
+        self._index_ready = False
+
+    def _ensure_index(self):
+        if not self._index_ready:
+            self.collection.create_index("sessionId", unique=True)
+            self._index_ready = True
+
+    async def get(self, session_id: str) -> dict:
+        session = self._sessions.get(session_id)
+        if session is not None:
+            self._sessions.move_to_end(session_id)
+            return session
+        session = {"summary": "", "turns": [], "summarizing": False}
+        if self.collection is not None:
+            try:
+                await asyncio.to_thread(self._ensure_index)
+                doc = await asyncio.to_thread(self.collection.find_one, {"sessionId": session_id}, {"_id": 0, "summary": 1, "turns": 1})
+                if doc:
+                    session["summary"] = doc.get("summary") or ""
+                    session["turns"] = [tuple(turn) for turn in doc.get("turns") or []]
+            except Exception as e:
+                logger.error(f"Conversation load error for {session_id}: {e}")
+        self._sessions[session_id] = session
+        while len(self._sessions) > self.max_sessions:
+            evicted_id, evicted = self._sessions.popitem(last=False)
+            await self._persist(evicted_id, evicted)
+        return session
+
+    async def _persist(self, session_id: str, session: dict):
+        if self.collection is None:
+            return
+        doc = {"sessionId": session_id, "summary": session["summary"], "turns": [list(turn) for turn in session["turns"]], "updatedAt": int(time.time())}
+        try:
+            await asyncio.to_thread(self._ensure_index)
+            await asyncio.to_thread(self.collection.update_one, {"sessionId": session_id}, {"$set": doc}, upsert=True)
+        except Exception as e:
+            logger.error(f"Conversation save error for {session_id}: {e}")
+
+    @staticmethod
+    def history(session: dict) -> list[str]:
+        segments = []
+        if session["summary"]:
+            segments.append(f"Summary of earlier conversation:\n{session['summary']}")
+        segments.extend(f"User: {user}\nAssistant: {assistant}" for user, assistant in session["turns"])
+        return segments
+
+    async def record_turn(self, session_id: str, user: str, assistant: str):
+        session = await self.get(session_id)
+        session["turns"].append((user, assistant))
+        # If summarization keeps failing, still don't let a session grow without bound
+        del session["turns"][:-4 * CONVERSATION_RECENT_TURNS]
+        if len(session["turns"]) > CONVERSATION_RECENT_TURNS and not session["summarizing"]:
+            session["summarizing"] = True
+            task = asyncio.create_task(self._summarize(session_id, session))
+            self._tasks.add(task)
+            task.add_done_callback(self._tasks.discard)
+
+    async def _summarize(self, session_id: str, session: dict):
+        older = session["turns"][:-CONVERSATION_RECENT_TURNS]
+        try:
+            transcript = "\n\n".join(f"User: {user}\nAssistant: {assistant}" for user, assistant in older)
+            prompt = (
+                "Update the running summary of a conversation between a user and a coding assistant. "
+                "Keep facts, decisions, names, code identifiers and open questions; drop pleasantries. "
+                f"Stay under {CONVERSATION_SUMMARY_TOKENS * 3 // 4} words. Return only the updated summary.\n\n"
+                f"CURRENT_SUMMARY:\n{session['summary'] or '(none)'}\n\n"
+                f"NEW_TURNS:\n{transcript}"
+            )
+            # Lite tier: no thinking tokens eating into the cap; headroom in case the chain falls back to a thinking model
+            response = await _generate_with_resilience(
+                prompt, PRIORITY_BACKGROUND, MODEL_TIERS.get("fast", DEFAULT_MODEL), temperature=0.2,
+                max_output_tokens=CONVERSATION_SUMMARY_TOKENS * 4,
+            )
+            summary = (response.text or "").strip()
+            if summary:
+                session["summary"] = summary
+                # Turns may have been trimmed while we waited; only drop the ones actually summarized
+                for turn in older:
+                    if session["turns"] and session["turns"][0] == turn:
+                        session["turns"].pop(0)
+        except Exception as e:
+            logger.error(f"Conversation summary error for {session_id}: {e}")
+        finally:
+            session["summarizing"] = False
+            if session_id not in self._sessions:
+                await self._persist(session_id, session)
+
+
+_conversations = _ConversationStore(CONVERSATION_MAX_SESSIONS, conversations_col)
+
+
+async def _read_messages(websocket: WebSocket, inbox: asyncio.Queue, disconnected: asyncio.Event):
+    # Keep reading while a turn streams so a closed socket is noticed right away, not on the next send
+    try:
+        while True:
+            inbox.put_nowait(await websocket.receive_text())
+    except Exception:
+        pass
+    finally:
+        disconnected.set()
+        inbox.put_nowait(None)
+
+
+def _ws_error(message: str, retry_after: int | None = None) -> str:
+    # A typed frame, so clients never mistake a failure for answer text
+    frame = {"type": "error", "message": message}
+    if retry_after:
+        frame["retryAfter"] = retry_after
+    return json.dumps(frame)
+
+
+async def _stream_turn(websocket: WebSocket, query: str, attachment: dict | None, session_id: str | None = None, with_suggestions: bool = False):
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + WS_TURN_TIMEOUT_SECONDS
+    history = _conversations.history(await _conversations.get(session_id)) if session_id else None
+    stream = _coalesce(process_query_streaming(query, attachment, history))
+    answer = []
+    completed = False
+    try:
+        while True:
+            remaining = deadline - loop.time()
+            if remaining <= 0:
+                raise asyncio.TimeoutError()
+            try:
+                chunk = await asyncio.wait_for(stream.__anext__(), timeout=min(WS_IDLE_TIMEOUT_SECONDS, remaining))
+            except StopAsyncIteration:
+                completed = True
+                break
+            answer.append(chunk)
+            await websocket.send_text(chunk)
+    except asyncio.TimeoutError:
+        logger.warning(f"WebSocket turn timed out for query: {query[:80]}")
+        await websocket.send_text(_ws_error("The response took too long and was stopped. Please try again."))
+    except (_Overloaded, _UpstreamUnavailable) as e:
+        await websocket.send_text(_ws_error(str(e), e.retry_after))
+    finally:
+        await stream.aclose()
+    await websocket.send_text("[END]")
+    if session_id and completed and answer:
+        # Only real answers become memory; failed, timed-out and rejected turns are never recorded
+        await _conversations.record_turn(session_id, query, "".join(answer))
+    if completed and answer and with_suggestions:
+        # Generated from the answer we already hold; saves the client a /suggestions round trip
+        return asyncio.create_task(_push_suggestions(websocket, "".join(answer)))
+    return None
+
+
+async def _push_suggestions(websocket: WebSocket, answer: str):
+    # Runs beside the receive loop, so the next prompt never waits on suggestion generation
+    try:
+        suggestions = await _suggest(answer)
+        await websocket.send_text(json.dumps({"type": "suggestions", "suggestions": suggestions}))
+    except Exception as e:
+        logger.warning(f"WebSocket suggestions failed: {e}")
+
+
 @app.websocket("/ws/chat")
 async def websocket_endpoint(websocket: WebSocket):
     await websocket.accept()
+    inbox: asyncio.Queue = asyncio.Queue()
+    disconnected = asyncio.Event()
+    reader = asyncio.create_task(_read_messages(websocket, inbox, disconnected))
+    # Optional ?token=<JWT>: conversation memory is then bound to that user
+    claims = _decode_jwt(websocket.query_params["token"]) if websocket.query_params.get("token") else None
+    user_id = str(claims["sub"]) if claims and claims.get("sub") else None
+    suggesting: asyncio.Task | None = None
     try:
         while True:
-            raw = await websocket.receive_text()
-            # Expect either a plain string (legacy) or a JSON string { prompt, image, attachment }
+            raw = await inbox.get()
+            if raw is None:
+                break
+            # Expect either a plain string (legacy) or a JSON string { prompt, image, attachment, sessionId, suggestions }
             query = raw
             try:
                 import json
@@ -242,64 +2197,340 @@ async def websocket_endpoint(websocket: WebSocket):
                 query = payload.get("prompt", raw)
                 image_data_url = payload.get("image")  # deprecated
                 attachment = payload.get("attachment")  # { data: dataUrl, mime: string }
+                # optional: enables server-side conversation memory; send any value (e.g. "new") to get an id issued
+                session_id = payload.get("sessionId")
+                with_suggestions = bool(payload.get("suggestions"))  # optional: push suggestions after [END]
             except Exception:
                 image_data_url = None
                 attachment = None
+                session_id = None
+                with_suggestions = False
 
             # Backward compatibility: map legacy image field to attachment
             if image_data_url and not attachment:
                 attachment = {"data": image_data_url, "mime": "image/*"}
 
-            async for chunk in process_query_streaming(query, attachment):
-                await websocket.send_text(chunk)
-            await websocket.send_text("[END]")
+            if session_id and not _valid_session_id(str(session_id), user_id):
+                session_id = _issue_session_id(user_id)
+                await websocket.send_text(json.dumps({"type": "session", "sessionId": session_id}))
+
+            if suggesting is not None:
+                # A new prompt makes the previous answer's suggestions stale
+                suggesting.cancel()
+            turn = asyncio.create_task(
+                _stream_turn(websocket, query, attachment, str(session_id) if session_id else None, with_suggestions)
+            )
+            gone = asyncio.create_task(disconnected.wait())
+            await asyncio.wait({turn, gone}, return_when=asyncio.FIRST_COMPLETED)
+            gone.cancel()
+            if not turn.done():
+                # Client went away mid-answer: stop pulling the upstream stream and free its slot
+                logger.info("WebSocket client disconnected mid-stream; cancelling upstream")
+                turn.cancel()
+                with contextlib.suppress(asyncio.CancelledError):
+                    await turn
+                break
+            suggesting = turn.result()
     except Exception as e:
         logger.error(f"WebSocket error: {e}")
-        await websocket.send_text(f"Error: {str(e)}")
-        await websocket.close()
+        if not disconnected.is_set():
+            with contextlib.suppress(Exception):
+                await websocket.send_text(_ws_error(str(e)))
+                await websocket.close()
+    finally:
+        reader.cancel()
+        if suggesting is not None:
+            suggesting.cancel()
 
 # HTTP endpoint for testing
 @app.get("/chat/{query}")
-async def chat(query: str):
-    response = await process_query_non_streaming(query)
+async def chat(query: str, cache: str = "default"):
+    response = await process_query_non_streaming(query, cache=cache)
     return {"response": response}
 
 
-@router.post("/suggestions")
-async def generate_suggestions(payload: dict = Body(...)):
-    """
-    Generate short, actionable follow-up suggestions tailored to the given AI response text.
-    Request body: { text: string }
+_suggestions_cache = _TTLCache(SUGGESTIONS_CACHE_MAX_ENTRIES, SUGGESTIONS_CACHE_MAX_BYTES)
+_suggestions_mongo_stats = {"hits": 0, "misses": 0}
+_suggestions_ttl_index_ready = False
+
+
+def _suggestions_mongo_get(key: str) -> list[str] | None:
+    doc = suggestions_cache_col.find_one({"_id": key, "expiresAt": {"$gt": datetime.datetime.utcnow()}}, {"suggestions": 1})
+    return doc.get("suggestions") if doc else None
+
+
+def _suggestions_mongo_set(key: str, suggestions: list[str]):
+    global _suggestions_ttl_index_ready
+    if not _suggestions_ttl_index_ready:
+        # Mongo's TTL monitor deletes documents once expiresAt has passed
+        suggestions_cache_col.create_index("expiresAt", expireAfterSeconds=0)
+        _suggestions_ttl_index_ready = True
+    expires = datetime.datetime.utcnow() + datetime.timedelta(seconds=SUGGESTIONS_CACHE_TTL_SECONDS)
+    suggestions_cache_col.update_one({"_id": key}, {"$set": {"suggestions": suggestions, "expiresAt": expires}}, upsert=True)
+
+
+_FENCE_RE = re.compile(r"^```[ \t]*([\w+#.-]*)", re.MULTILINE)
+_CITATION_RE = re.compile(r"https?://|\[source[:\]]|\[\d+\]|\bsources?:", re.IGNORECASE)
+_ERROR_RE = re.compile(r"Traceback \(most recent call last\)|\b\w+(?:Error|Exception):|\bstack trace\b")
+_LIST_ITEM_RE = re.compile(r"^\s*(?:[-*•]|\d+[.)])\s+\S", re.MULTILINE)
+_TABLE_ROW_RE = re.compile(r"^\s*\|.*\|\s*$", re.MULTILINE)
+_CODE_LANGUAGES = {
+    "python": "Python", "py": "Python", "javascript": "JavaScript", "js": "JavaScript", "jsx": "React",
+    "typescript": "TypeScript", "ts": "TypeScript", "tsx": "React", "java": "Java", "kotlin": "Kotlin",
+    "go": "Go", "rust": "Rust", "rs": "Rust", "c": "C", "cpp": "C++", "c++": "C++", "csharp": "C#",
+    "cs": "C#", "c#": "C#", "ruby": "Ruby", "rb": "Ruby", "php": "PHP", "swift": "Swift", "sql": "SQL",
+    "bash": "shell", "sh": "shell", "shell": "shell", "html": "HTML", "css": "CSS",
+}
+_suggestion_path_stats = {"fast_only": 0, "merged": 0, "budget_timeouts": 0}
+_background_suggestions: set[asyncio.Task] = set()
+
+
+def _fast_suggestions(text: str) -> list[str]:
+    # Rule-based suggestions: no model call, so they're available even when Gemini is saturated
+    out: list[str] = []
+    fences = _FENCE_RE.findall(text)
+    if len(fences) >= 2:
+        # Fences come in open/close pairs; only the opening one carries the language tag
+        language = next((_CODE_LANGUAGES[tag.lower()] for tag in fences[::2] if tag.lower() in _CODE_LANGUAGES), None)
+        if language in (None, "shell", "SQL", "HTML", "CSS"):
+            out.append("Explain this code step by step")
+        else:
+            out.append(f"Add unit tests for this {language} code")
+            out.append("Explain this code step by step")
+        out.append("Refactor this for readability")
+    if _ERROR_RE.search(text):
+        out.append("Explain the root cause of this error")
+    if _CITATION_RE.search(text):
+        out.append("Show more sources")
+        out.append("Summarize what each source says")
+    if len(_TABLE_ROW_RE.findall(text)) >= 3:
+        out.append("Convert this table to CSV")
+    if len(_LIST_ITEM_RE.findall(text)) >= 3:
+        out.append("Go deeper on the first point")
+    if len(text) > 1500:
+        out.append("Summarize this in three bullet points")
+    out.extend(["Give a concrete example", "Explain this in simpler terms"])
+    return _merge_suggestions(out)
+
+
+def _merge_suggestions(*groups: list[str]) -> list[str]:
+    seen: set[str] = set()
+    merged: list[str] = []
+    for group in groups:
+        for suggestion in group:
+            norm = suggestion.strip().rstrip(".").lower()
+            if norm and norm not in seen:
+                seen.add(norm)
+                merged.append(suggestion.strip())
+    return merged[:SUGGESTIONS_MAX]
+
+
+def _model_overloaded() -> bool:
+    # Same signals that make chat calls queue or shed; suggestions shouldn't add to that pressure
+    if _breaker(DEFAULT_MODEL).state == "open":
+        return True
+    return bool(_gemini_limiter._waiters) or _gemini_limiter.in_flight >= int(_gemini_limiter.limit)
+
+
+async def _suggest(text: str, latency_budget_ms: float | None = None) -> list[str]:
+    # Shared by POST /suggestions and the streams that push suggestions right after an answer
+    if not text:
+        return []
+    fast = _fast_suggestions(text)
+    key = hashlib.sha256(text.encode("utf-8")).hexdigest()
+    cached = await _cached_suggestions(key)
+    if cached is not None:
+        return _merge_suggestions(cached, fast)
+
+    budget_ms = SUGGESTIONS_LATENCY_BUDGET_MS if latency_budget_ms is None else latency_budget_ms
+    if budget_ms < SUGGESTIONS_MIN_MODEL_BUDGET_MS or _model_overloaded():
+        _suggestion_path_stats["fast_only"] += 1
+        return fast
+    task = asyncio.ensure_future(_model_suggestions(text, key))
+    try:
+        suggestions = await asyncio.wait_for(asyncio.shield(task), timeout=budget_ms / 1000)
+    except asyncio.TimeoutError:
+        # Let the model call finish in the background so the next request for this text hits the cache
+        _background_suggestions.add(task)
+        task.add_done_callback(_background_suggestions.discard)
+        _suggestion_path_stats["budget_timeouts"] += 1
+        return fast
+    _suggestion_path_stats["merged"] += 1
+    return _merge_suggestions(suggestions, fast)
+
+
+async def _cached_suggestions(key: str) -> list[str] | None:
+    cached = _suggestions_cache.get(key)
+    if cached is not None:
+        return list(cached)
+    if suggestions_cache_col is not None:
+        try:
+            cached = await asyncio.to_thread(_suggestions_mongo_get, key)
+        except Exception as e:
+            logger.error(f"Suggestions cache read error: {e}")
+            cached = None
+        _suggestions_mongo_stats["hits" if cached else "misses"] += 1
+        if cached:
+            _suggestions_cache.set(key, list(cached), SUGGESTIONS_CACHE_TTL_SECONDS, size=sum(len(s) for s in cached))
+            return list(cached)
+    return None
+
+
+async def _model_suggestions(text: str, key: str) -> list[str]:
+    suggestions = await _generate_suggestions(text)
+    if suggestions:
+        _suggestions_cache.set(key, list(suggestions), SUGGESTIONS_CACHE_TTL_SECONDS, size=sum(len(s) for s in suggestions))
+        if suggestions_cache_col is not None:
+            try:
+                await asyncio.to_thread(_suggestions_mongo_set, key, suggestions)
+            except Exception as e:
+                logger.error(f"Suggestions cache write error: {e}")
+    return suggestions
+
+
+_SUGGESTIONS_INSTRUCTIONS = (
+    "You are a writing and coding assistant. Given the following assistant response, "
+    "propose 3-5 short follow-up prompts the user could click to get better results. "
+    "Keep each suggestion under 120 characters, imperative mood, no numbering, no quotes. "
+    "If the response includes code, include at least one testing or refactor suggestion."
+)
+
+
+class _SuggestionBatcher:
+    """Collects suggestion requests for a short window and answers them with one batched prompt.
+
+    A batch flushes when it reaches max_size or max_wait after its first request. If the model's
+    reply isn't an array with one array per response, every request in the batch falls back to its
+    own single call.
     """
+
+    def __init__(self, max_size: int, max_wait: float):
+        self.max_size = max(1, max_size)
+        self.max_wait = max_wait
+        self._pending: list[tuple[str, asyncio.Future]] = []
+        self._timer: asyncio.TimerHandle | None = None
+        self.batches = 0
+        self.batched_requests = 0
+        self.parse_failures = 0
+
+    async def submit(self, text: str) -> list[str]:
+        if self.max_size == 1:
+            return await _generate_single_suggestions(text)
+        fut = asyncio.get_running_loop().create_future()
+        self._pending.append((text, fut))
+        if len(self._pending) >= self.max_size:
+            self._flush()
+        elif self._timer is None:
+            self._timer = asyncio.get_running_loop().call_later(self.max_wait, self._flush)
+        # Shielded so one caller giving up doesn't cancel the batch for everyone else in it
+        return await asyncio.shield(fut)
+
+    def _flush(self):
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.ensure_future(self._run(batch))
+            _background_suggestions.add(task)
+            task.add_done_callback(_background_suggestions.discard)
+
+    async def _run(self, batch: list[tuple[str, asyncio.Future]]):
+        if len(batch) == 1:
+            results = [await _generate_single_suggestions(batch[0][0])]
+        else:
+            self.batches += 1
+            self.batched_requests += len(batch)
+            results = await self._generate_batch([text for text, _ in batch])
+            if results is None:
+                self.parse_failures += 1
+                results = await asyncio.gather(*(_generate_single_suggestions(text) for text, _ in batch))
+        for (_, fut), suggestions in zip(batch, results):
+            if not fut.done():
+                fut.set_result(suggestions)
+
+    async def _generate_batch(self, texts: list[str]) -> list[list[str]] | None:
+        responses = "\n\n".join(f"### RESPONSE {i + 1}\n{text}" for i, text in enumerate(texts))
+        prompt = (
+            f"{_SUGGESTIONS_INSTRUCTIONS}\n\n"
+            f"Do this independently for each of the {len(texts)} assistant responses below.\n\n"
+            f"{responses}\n\n"
+            f"Return a single JSON array of arrays with exactly {len(texts)} elements, one array of "
+            "suggestion strings per response, in the same order. JSON only."
+        )
+        try:
+            res = await _hedger.run("suggestions_batch", lambda: _generate_with_resilience(prompt, PRIORITY_BACKGROUND, DEFAULT_MODEL, temperature=0.3))
+            arr = json.loads(_strip_json_fence(res.text or ""))
+        except Exception as e:
+            logger.warning(f"Batched suggestions failed for {len(texts)} responses: {e}")
+            return None
+        if not isinstance(arr, list) or len(arr) != len(texts) or not all(isinstance(item, list) for item in arr):
+            logger.warning(f"Batched suggestions reply didn't match {len(texts)} responses; falling back to single calls")
+            return None
+        return [[str(s) for s in item][:SUGGESTIONS_MAX] for item in arr]
+
+    def stats(self) -> dict:
+        return {
+            "max_size": self.max_size,
+            "max_wait_ms": int(self.max_wait * 1000),
+            "batches": self.batches,
+            "batched_requests": self.batched_requests,
+            "parse_failures": self.parse_failures,
+        }
+
+
+_suggestion_batcher = _SuggestionBatcher(SUGGESTIONS_BATCH_MAX_SIZE, SUGGESTIONS_BATCH_MAX_WAIT_MS / 1000)
+
+
+def _strip_json_fence(raw: str) -> str:
+    # Models sometimes wrap JSON in a ```json fence despite being asked not to
+    raw = raw.strip()
+    if raw.startswith("```"):
+        raw = raw.split("\n", 1)[1] if "\n" in raw else ""
+        raw = raw.rsplit("```", 1)[0]
+    return raw.strip()
+
+
+async def _generate_suggestions(text: str) -> list[str]:
+    return await _suggestion_batcher.submit(text)
+
+
+async def _generate_single_suggestions(text: str) -> list[str]:
     try:
-        text = (payload or {}).get("text", "")
-        if not text:
-            return {"suggestions": []}
-        model = GenerativeModel("gemini-2.5-flash", generation_config=GenerationConfig(temperature=0.3))
         prompt = (
-            "You are a writing and coding assistant. Given the following assistant response, "
-            "propose 3-5 short follow-up prompts the user could click to get better results. "
-            "Keep each suggestion under 120 characters, imperative mood, no numbering, no quotes. "
-            "If the response includes code, include at least one testing or refactor suggestion.\n\n"
+            f"{_SUGGESTIONS_INSTRUCTIONS}\n\n"
             f"ASSISTANT_RESPONSE:\n{text}\n\n"
             "Return suggestions as a single JSON array of strings only."
         )
-        res = model.generate_content(prompt)
+        res = await _hedger.run("suggestions", lambda: _generate_with_resilience(prompt, PRIORITY_BACKGROUND, DEFAULT_MODEL, temperature=0.3))
         raw = res.text or "[]"
-        import json as _json
         try:
-            arr = _json.loads(raw)
+            arr = json.loads(_strip_json_fence(raw))
             if isinstance(arr, list):
-                suggestions = [str(s) for s in arr][:5]
+                suggestions = [str(s) for s in arr][:SUGGESTIONS_MAX]
             else:
                 suggestions = []
         except Exception:
             # Fallback: split lines
-            suggestions = [s.strip("- •\t ") for s in raw.splitlines() if s.strip()][:5]
-        return {"suggestions": suggestions}
+            suggestions = [s.strip("- •\t ") for s in raw.splitlines() if s.strip()][:SUGGESTIONS_MAX]
+        return suggestions
     except Exception as e:
         logger.error(f"suggestions error: {e}")
-        return {"suggestions": []}
+        return []
+
+
+@router.post("/suggestions")
+async def generate_suggestions(payload: dict = Body(...)):
+    """
+    Generate short, actionable follow-up suggestions tailored to the given AI response text.
+    Request body: { text: string, latency_budget_ms?: number }
+    """
+    text = (payload or {}).get("text", "")
+    try:
+        latency_budget_ms = float((payload or {}).get("latency_budget_ms"))
+    except (TypeError, ValueError):
+        latency_budget_ms = None
+    return {"suggestions": await _suggest(text, latency_budget_ms)}
 
 
 # ===================== AUTH =====================
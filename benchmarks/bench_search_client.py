@@ -0,0 +1,69 @@
+"""Microbenchmark: building the Custom Search client per search vs. one shared client with a reused transport.
+
+Runs against a local keep-alive HTTP server, so it measures client setup and connection reuse only
+(no TLS handshake to googleapis.com, which the reused connection also saves in production).
+
+    python benchmarks/bench_search_client.py [searches]
+"""
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from googleapiclient.discovery import build
+from googleapiclient.http import build_http
+
+
+class _SearchStub(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like googleapis.com
+    wbufsize = -1
+
+    def do_GET(self):
+        body = json.dumps({"items": [{"title": "t", "snippet": "s", "link": "https://example.com"}]}).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+def _per_search_build(endpoint: str, n: int) -> float:
+    # The old perform_search: a fresh service (and HTTP client) for every query
+    started = time.perf_counter()
+    for _ in range(n):
+        service = build("customsearch", "v1", developerKey="bench", client_options={"api_endpoint": endpoint})
+        service.cse().list(q="query", cx="bench", num=3).execute()
+    return (time.perf_counter() - started) / n * 1000
+
+
+def _shared_service(endpoint: str, n: int) -> float:
+    # What perform_search does now: one static-discovery service, one transport per worker thread
+    service = build(
+        "customsearch", "v1", developerKey="bench", client_options={"api_endpoint": endpoint},
+        static_discovery=True, cache_discovery=False,
+    )
+    http = build_http()
+    started = time.perf_counter()
+    for _ in range(n):
+        service.cse().list(q="query", cx="bench", num=3).execute(http=http)
+    return (time.perf_counter() - started) / n * 1000
+
+
+def main():
+    n = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _SearchStub)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    endpoint = f"http://127.0.0.1:{server.server_port}/"
+    try:
+        print(f"build() per search:               {_per_search_build(endpoint, n):.2f} ms/search")
+        print(f"shared service + reused transport: {_shared_service(endpoint, n):.2f} ms/search")
+    finally:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+import os
+import sys
+
+import pytest
+
+# Set before backend/app.py loads its .env (load_dotenv never overrides existing variables):
+# no Mongo, no web search, and the simulated model instead of Gemini.
+os.environ["MONGO_URL"] = ""
+os.environ["GOOGLE_API_KEY"] = ""
+os.environ["GOOGLE_CSE_ID"] = ""
+os.environ.setdefault("GEMINI_API_KEY", "test")
+os.environ["LLM_PROVIDER"] = "fake"
+os.environ["FAKE_LLM_TTFT_SECONDS"] = "0.2"
+os.environ["FAKE_LLM_CHUNK_DELAY_SECONDS"] = "0.05"
+os.environ["FAKE_LLM_CHUNKS"] = "10"
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "backend"))
+
+
+@pytest.fixture(autouse=True)
+def fresh_resilience_state(monkeypatch):
+    # Failures injected by one test halve the adaptive limit and trip breakers; don't let that leak into the next
+    import app as backend
+
+    monkeypatch.setattr(backend, "_gemini_limiter", backend._AdaptiveLimiter(
+        backend.GEMINI_INITIAL_CONCURRENCY,
+        backend.GEMINI_MIN_CONCURRENCY,
+        backend.GEMINI_MAX_CONCURRENCY,
+        backend.GEMINI_QUEUE_SIZE,
+        backend.GEMINI_TARGET_LATENCY_SECONDS,
+    ))
+    backend._breakers.clear()
+    yield
+    backend._breakers.clear()
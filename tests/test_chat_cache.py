@@ -0,0 +1,37 @@
+import asyncio
+
+from fastapi.testclient import TestClient
+
+import app as backend
+
+
+def test_unknown_cache_mode_is_rejected():
+    with TestClient(backend.app) as client:
+        response = client.get("/chat/hello", params={"cache": "foo"})
+    assert response.status_code == 400
+    assert "default, refresh, bypass" in response.json()["detail"]
+
+
+def test_bypass_neither_reads_nor_writes_the_cache():
+    with TestClient(backend.app) as client:
+        client.get("/chat/cache probe", params={"cache": "bypass"})
+        key = asyncio.run(backend._request_key("cache probe", None))
+        assert backend._response_cache.get(key) is None
+        client.get("/chat/cache probe")
+        assert backend._response_cache.get(key) is not None
+
+
+def test_large_attachment_is_hashed_off_the_event_loop(monkeypatch):
+    hashed_on = []
+    real_digest = backend._attachment_digest
+
+    def digest(attachment):
+        hashed_on.append(backend.threading.current_thread() is backend.threading.main_thread())
+        return real_digest(attachment)
+
+    monkeypatch.setattr(backend, "_attachment_digest", digest)
+    large = {"data": "data:application/pdf;base64," + "A" * (backend._ATTACHMENT_DIGEST_INLINE_BYTES + 1)}
+    small = {"data": "data:image/png;base64,AAAA"}
+    keys = [asyncio.run(backend._request_key("q", attachment)) for attachment in (large, small, dict(large))]
+    assert hashed_on == [False, True, False]
+    assert keys[0] == keys[2] != keys[1]
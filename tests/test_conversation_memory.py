@@ -0,0 +1,45 @@
+import json
+
+from fastapi.testclient import TestClient
+
+import app as backend
+
+
+def _turn(ws, payload: dict) -> list[str]:
+    ws.send_text(json.dumps(payload))
+    frames = []
+    while (frame := ws.receive_text()) != "[END]":
+        frames.append(frame)
+    return frames
+
+
+def test_session_ids_are_issued_by_the_server():
+    with TestClient(backend.app) as client:
+        with client.websocket_connect("/ws/chat") as ws:
+            frames = _turn(ws, {"prompt": "remember the number 7", "sessionId": "someone-elses-session"})
+            session = json.loads(frames[0])
+            assert session["type"] == "session" and session["sessionId"] != "someone-elses-session"
+
+            # The issued id is accepted as is, and the first turn is now in its history
+            frames = _turn(ws, {"prompt": "what number?", "sessionId": session["sessionId"]})
+            assert not frames[0].startswith('{"type": "session"')
+    memory = backend._conversations._sessions[session["sessionId"]]
+    assert [user for user, _ in memory["turns"]] == ["remember the number 7", "what number?"]
+
+
+def test_session_ids_are_bound_to_the_user():
+    issued = backend._issue_session_id("user-a")
+    assert backend._valid_session_id(issued, "user-a")
+    assert not backend._valid_session_id(issued, "user-b")
+    assert not backend._valid_session_id(issued, None)
+
+
+def test_failed_turns_are_not_remembered(monkeypatch):
+    session_id = backend._issue_session_id(None)
+    monkeypatch.setattr(backend._provider, "error_rate", 1.0)
+    monkeypatch.setattr(backend, "GEMINI_MAX_RETRIES", 0)
+    with TestClient(backend.app) as client:
+        with client.websocket_connect("/ws/chat") as ws:
+            frames = _turn(ws, {"prompt": "this turn fails", "sessionId": session_id})
+    assert json.loads(frames[-1])["type"] == "error"
+    assert backend._conversations._sessions.get(session_id, {"turns": []})["turns"] == []
@@ -0,0 +1,157 @@
+import asyncio
+import socket
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+import app as backend
+
+
+class _Pages(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    hits: list[tuple[str, str]] = []
+
+    def do_GET(self):
+        _Pages.hits.append((self.path, self.headers.get("Host", "")))
+        if self.path == "/hop":
+            return self._redirect("http://169.254.169.254/latest/meta-data/")
+        if self.path == "/moved":
+            return self._redirect("/page")
+        if self.path == "/big":
+            return self._send(b"x" * (4 * 1024 * 1024), "text/plain")
+        if self.path == "/slow":
+            time.sleep(1)
+        self._send(
+            b"<html><head><style>p{}</style><script>var hidden = 1;</script></head>"
+            b"<body><nav>menu</nav><p>Readable   page\ntext</p></body></html>",
+            "text/html; charset=utf-8",
+        )
+
+    def _redirect(self, location):
+        self.send_response(302)
+        self.send_header("Location", location)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def _send(self, body, content_type):
+        self.send_response(200)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        try:
+            self.wfile.write(body)
+        except OSError:
+            pass  # the client stopped reading early
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture
+def local_site():
+    _Pages.hits = []
+    server = ThreadingHTTPServer(("127.0.0.1", 0), _Pages)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f"http://127.0.0.1:{server.server_port}"
+    server.shutdown()
+
+
+@pytest.fixture
+def trusted_loopback(monkeypatch):
+    # Treat the loopback stub server as a public site; every other address is still checked for real
+    real = backend._blocked_address
+    monkeypatch.setattr(backend, "_blocked_address", lambda address: address != "127.0.0.1" and real(address))
+
+
+def _run(coro_fn, *args):
+    async def run():
+        try:
+            return await coro_fn(*args)
+        finally:
+            await backend._close_enrich_clients()
+
+    return asyncio.run(run())
+
+
+@pytest.mark.parametrize("address", ["127.0.0.1", "10.0.0.5", "169.254.169.254", "::1", "::ffff:192.168.1.1", "0.0.0.0"])
+def test_non_public_addresses_are_blocked(address):
+    assert backend._blocked_address(address)
+
+
+def test_public_address_is_allowed():
+    assert not backend._blocked_address("93.184.216.34")
+
+
+def test_loopback_result_is_never_fetched(local_site):
+    blocked = backend._enrich_stats["blocked"]
+    assert _run(backend._fetch_page_text, f"{local_site}/admin") == ""
+    assert _Pages.hits == []
+    assert backend._enrich_stats["blocked"] == blocked + 1
+
+
+def test_redirect_to_private_address_is_not_followed(local_site, trusted_loopback):
+    blocked = backend._enrich_stats["blocked"]
+    assert _run(backend._fetch_page_text, f"{local_site}/hop") == ""
+    assert [path for path, _ in _Pages.hits] == ["/hop"]
+    assert backend._enrich_stats["blocked"] == blocked + 1
+
+
+def test_page_text_is_extracted(local_site, trusted_loopback):
+    assert _run(backend._fetch_page_text, f"{local_site}/page") == "Readable page\ntext"
+
+
+def test_relative_redirect_is_followed(local_site, trusted_loopback):
+    assert _run(backend._fetch_page_text, f"{local_site}/moved") == "Readable page\ntext"
+    assert [path for path, _ in _Pages.hits] == ["/moved", "/page"]
+
+
+def test_connection_goes_to_the_checked_address(local_site, trusted_loopback, monkeypatch):
+    # DNS rebinding: the name first resolves to the allowed address, then to somewhere else
+    port = int(local_site.rsplit(":", 1)[1])
+    answers = iter(["127.0.0.1"])
+    real_getaddrinfo = socket.getaddrinfo
+
+    def rebinding_getaddrinfo(host, *args, **kwargs):
+        if host != "rebind.test":
+            return real_getaddrinfo(host, *args, **kwargs)
+        address = next(answers, "192.0.2.1")
+        return [(socket.AF_INET, socket.SOCK_STREAM, socket.IPPROTO_TCP, "", (address, port))]
+
+    monkeypatch.setattr(socket, "getaddrinfo", rebinding_getaddrinfo)
+    assert _run(backend._fetch_page_text, f"http://rebind.test:{port}/page") == "Readable page\ntext"
+    assert _Pages.hits == [("/page", f"rebind.test:{port}")]
+
+
+def test_page_bytes_are_capped(local_site, trusted_loopback, monkeypatch):
+    monkeypatch.setattr(backend, "SEARCH_ENRICH_MAX_PAGE_BYTES", 1024)
+    monkeypatch.setattr(backend, "_extract_page_text", lambda body, encoding, content_type: str(len(body)))
+    truncated = backend._enrich_stats["truncated"]
+    assert _run(backend._fetch_page_text, f"{local_site}/big") == "1024"
+    assert backend._enrich_stats["truncated"] == truncated + 1
+
+
+def test_repeat_fetch_is_served_from_cache(local_site, trusted_loopback):
+    hits = backend._enrich_stats["cache_hits"]
+    url = f"{local_site}/page?cached"
+    assert _run(backend._fetch_page_text, url) == _run(backend._fetch_page_text, url) == "Readable page\ntext"
+    assert len(_Pages.hits) == 1
+    assert backend._enrich_stats["cache_hits"] == hits + 1
+
+
+def test_pages_over_budget_are_left_out(local_site, trusted_loopback, monkeypatch):
+    monkeypatch.setattr(backend, "SEARCH_ENRICH_BUDGET_SECONDS", 0.5)
+    over_budget = backend._enrich_stats["over_budget"]
+    search = {
+        "results": [
+            {"title": "fast", "snippet": "", "link": f"{local_site}/page?fast"},
+            {"title": "slow", "snippet": "", "link": f"{local_site}/slow"},
+        ],
+        "error": None,
+    }
+    enriched = _run(backend._enrich_search, search)
+    assert enriched["results"][0]["content"] == "Readable page\ntext"
+    assert "content" not in enriched["results"][1]
+    assert "content" not in search["results"][0]
+    assert backend._enrich_stats["over_budget"] == over_budget + 1
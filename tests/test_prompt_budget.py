@@ -0,0 +1,56 @@
+import app as backend
+
+
+def _search(n: int, snippet_words: int) -> dict:
+    return {
+        "results": [
+            {"title": f"Result title {i}", "snippet": "word " * snippet_words, "link": f"https://example.com/{i}"}
+            for i in range(n)
+        ],
+        "error": None,
+    }
+
+
+def test_search_results_are_cut_at_whole_results():
+    search = _search(5, 200)
+    full = backend._format_search_results(search)
+    budget = backend._estimate_tokens(full) // 2
+    kept = backend._format_search_results(search, budget)
+    assert 0 < backend._estimate_tokens(kept) <= budget
+    # Every kept result is complete: it ends with its source line
+    blocks = kept.split("**Result ")[1:]
+    assert blocks and all("- **Source**:" in block for block in blocks)
+    assert len(blocks) < 5
+
+
+def test_search_section_is_dropped_when_no_result_fits():
+    assert backend._format_search_results(_search(2, 400), 10) == ""
+
+
+def test_ocr_text_keeps_whole_pages():
+    pages = ["page one " * 50, "page two " * 50, "page three " * 50]
+    text = "\f".join(pages)
+    kept = backend._truncate_whole(text, backend._estimate_tokens(pages[0] + pages[1]) + 5)
+    assert kept.split("\f") == pages[:2]
+
+
+def test_single_oversized_page_falls_back_to_whole_paragraphs():
+    text = "\n\n".join(f"paragraph {i} " * 40 for i in range(4))
+    kept = backend._truncate_whole(text, backend._estimate_tokens(text) // 2)
+    assert kept and all(p in text.split("\n\n") for p in kept.split("\n\n"))
+
+
+def test_dense_page_without_paragraphs_falls_back_to_whole_lines():
+    # PyMuPDF separates lines with a single newline; a dense page has no blank lines at all
+    lines = [f"line {i} of a dense scanned page with plenty of words on it" for i in range(12000)]
+    page = "\n".join(lines)
+    text = page + "\f" + "short second page"
+    kept = backend._truncate_whole(text, 2000)
+    assert kept and backend._estimate_tokens(kept) <= 2000
+    assert kept.split("\n") == lines[:len(kept.split("\n"))]
+    parts = backend._build_content_parts("summarize this", {"mime_type": "application/pdf", "data": b""}, page)
+    assert any(isinstance(part, str) and part.startswith("line 0 of a dense") for part in parts)
+
+
+def test_gives_up_only_when_no_single_line_fits():
+    assert backend._truncate_whole("x" * 4000 + "\n" + "y" * 4000, 100) == ""
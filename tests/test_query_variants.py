@@ -0,0 +1,48 @@
+import app as backend
+
+
+def test_sentence_initial_verb_is_not_an_entity():
+    assert backend._query_variants("Compare React and Vue for SPA")[-1] == '"React" "Vue" "SPA" Compare'
+
+
+def test_sentence_initial_name_kept_with_evidence():
+    assert backend._query_variants("GraphQL vs REST")[-1] == '"GraphQL" "REST" vs'
+    assert backend._query_variants("React vs Vue: is React faster")[-1] == '"React" "Vue" vs faster'
+
+
+def test_no_entity_variant_from_position_alone():
+    assert backend._query_variants("Best laptop for students") == ["Best laptop for students", "Best laptop students"]
+
+
+def _result(link):
+    return {"title": link, "snippet": "", "link": link}
+
+
+def test_fusion_treats_scheme_www_fragment_and_trailing_slash_as_one_page():
+    fused = backend._reciprocal_rank_fusion([
+        [_result("https://www.example.com/page/"), _result("https://other.org/a")],
+        [_result("https://other.org/a"), _result("http://example.com/page#section")],
+    ], limit=5)
+    # Both pages appear once with summed scores; the first-seen copy is the one kept
+    assert [item["link"] for item in fused] == ["https://www.example.com/page/", "https://other.org/a"]
+
+
+def test_fusion_caps_results_per_domain():
+    lists = [[_result("https://docs.example.com/1"), _result("https://docs.example.com/2"), _result("https://b.org/")]]
+    assert [item["link"] for item in backend._reciprocal_rank_fusion(lists, limit=5)] == [
+        "https://docs.example.com/1", "https://b.org/",
+    ]
+    assert len(backend._reciprocal_rank_fusion(lists, limit=5, max_per_domain=2)) == 3
+
+
+def test_fusion_stops_at_limit_and_ranks_agreement_first():
+    fused = backend._reciprocal_rank_fusion([
+        [_result("https://a.com/"), _result("https://b.com/"), _result("https://c.com/")],
+        [_result("https://c.com/"), _result("https://d.com/")],
+    ], limit=2)
+    assert [item["link"] for item in fused] == ["https://c.com/", "https://a.com/"]
+
+
+def test_fusion_ties_keep_first_seen_order():
+    fused = backend._reciprocal_rank_fusion([[_result("https://a.com/")], [_result("https://b.com/")]], limit=5)
+    assert [item["link"] for item in fused] == ["https://a.com/", "https://b.com/"]
@@ -0,0 +1,28 @@
+import app as backend
+
+
+def test_short_one_off_prompt_goes_to_the_fast_tier():
+    assert backend._route("what is a monad?", None, False)["tier"] == "fast"
+
+
+def test_short_follow_up_in_a_long_conversation_stays_on_standard():
+    history = ["User: explain the trade-offs of event sourcing\nAssistant: " + "Event sourcing stores every change. " * 100]
+    route = backend._route("why?", None, False, history)
+    assert route["tier"] == "standard"
+    assert route["features"]["history_chars"] == len(history[0])
+
+
+def test_code_in_the_conversation_counts_as_a_code_hint():
+    history = ["User: fix this\n```python\ndef f(x):\n    return x\n```\nAssistant: done"]
+    route = backend._route("and the second one?", None, False, history)
+    assert route["features"]["code_hint"]
+    assert route["tier"] == "standard"
+
+
+def test_operators_can_route_on_history_size(monkeypatch):
+    monkeypatch.setattr(backend, "ROUTING_RULES", [
+        {"when": {"min_history_chars": 100}, "tier": "standard", "max_output_tokens": 2048},
+        {"tier": "fast"},
+    ])
+    assert backend._route("why?", None, False, ["x" * 100])["max_output_tokens"] == 2048
+    assert backend._route("why?", None, False, ["x" * 99])["tier"] == "fast"
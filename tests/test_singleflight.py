@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+
+import app as backend
+
+
+async def _first_chunk_then_disconnect(query):
+    # Like a WebSocket turn cancelled when its client goes away
+    first = asyncio.Event()
+
+    async def consume():
+        async for _ in backend.process_query_streaming(query):
+            first.set()
+
+    task = asyncio.create_task(consume())
+    await first.wait()
+    task.cancel()
+    # One loop turn: the consumer unsubscribes and cancels the pump, which hasn't unwound yet
+    await asyncio.sleep(0)
+    return task
+
+
+def test_request_after_last_subscriber_leaves_gets_a_full_answer():
+    async def scenario():
+        leaver = await _first_chunk_then_disconnect("a shared question")
+        # The abandoned stream is still unwinding; this must not join it
+        chunks = [chunk async for chunk in backend.process_query_streaming("a shared question")]
+        with pytest.raises(asyncio.CancelledError):
+            await leaver
+        return chunks
+
+    chunks = asyncio.run(scenario())
+    assert len(chunks) == backend._provider.chunks
+
+
+def test_subscriber_of_a_cancelled_stream_raises():
+    async def scenario():
+        async def source():
+            for i in range(100):
+                await asyncio.sleep(0.01)
+                yield f"c{i} "
+
+        shared = backend._SharedStream(source())
+        await asyncio.sleep(0.03)
+        shared.task.cancel()
+        with pytest.raises(backend._UpstreamUnavailable):
+            async for _ in shared.subscribe():
+                pass
+
+    asyncio.run(scenario())
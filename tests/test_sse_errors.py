@@ -0,0 +1,29 @@
+import asyncio
+
+import app as backend
+
+
+def _events(query, **kwargs):
+    async def collect():
+        return [event async for event in backend._sse_chat_events(query, **kwargs) if event.startswith("event:")]
+
+    return asyncio.run(collect())
+
+
+def test_failed_stream_ends_with_error_event(monkeypatch):
+    monkeypatch.setattr(backend._provider, "error_rate", 1.0)
+    monkeypatch.setattr(backend, "GEMINI_MAX_RETRIES", 0)
+    events = _events("will this sse stream fail", with_suggestions=True)
+    assert events[-1].startswith("event: error")
+    assert "Model unavailable" in events[-1]
+    assert not any(event.startswith(("event: end", "event: suggestions")) for event in events)
+
+
+def test_rejected_stream_carries_retry_after(monkeypatch):
+    async def rejected(*args, **kwargs):
+        raise backend._Overloaded(7)
+        yield
+
+    monkeypatch.setattr(backend, "_stream_answer", rejected)
+    events = _events("is there capacity")
+    assert events == ['event: error\ndata: {"message": "Model capacity exhausted; retry after 7s", "retryAfter": 7}\n\n']
@@ -0,0 +1,40 @@
+import json
+
+import pytest
+from fastapi.testclient import TestClient
+
+import app as backend
+
+
+@pytest.fixture
+def failing_model(monkeypatch):
+    monkeypatch.setattr(backend._provider, "error_rate", 1.0)
+    monkeypatch.setattr(backend, "GEMINI_MAX_RETRIES", 0)
+
+
+def test_failed_answer_is_a_503_not_answer_text(failing_model):
+    with TestClient(backend.app) as client:
+        response = client.get("/chat/will this fail", params={"cache": "bypass"})
+    assert response.status_code == 503
+    assert "Model unavailable" in response.json()["detail"]
+
+
+def test_open_breakers_send_retry_after(failing_model, monkeypatch):
+    monkeypatch.setattr(backend, "GEMINI_BREAKER_FAILURES", 1)
+    with TestClient(backend.app) as client:
+        client.get("/chat/trip the breakers", params={"cache": "bypass"})
+        response = client.get("/chat/breakers are open now", params={"cache": "bypass"})
+    assert response.status_code == 503
+    assert int(response.headers["Retry-After"]) >= 1
+
+
+def test_websocket_failure_is_a_typed_error_frame(failing_model):
+    with TestClient(backend.app) as client:
+        with client.websocket_connect("/ws/chat") as ws:
+            ws.send_text("will this stream fail")
+            frames = []
+            while (frame := ws.receive_text()) != "[END]":
+                frames.append(frame)
+    assert len(frames) == 1
+    error = json.loads(frames[0])
+    assert error["type"] == "error" and "Model unavailable" in error["message"]
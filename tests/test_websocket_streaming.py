@@ -0,0 +1,77 @@
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from fastapi.testclient import TestClient
+
+import app as backend
+
+STREAMS = 8
+
+
+def _chat(client: TestClient, prompt: str) -> str:
+    with client.websocket_connect("/ws/chat") as ws:
+        ws.send_text(prompt)
+        frames = []
+        while (frame := ws.receive_text()) != "[END]":
+            frames.append(frame)
+    return "".join(frames)
+
+
+def test_concurrent_streams_finish_in_about_the_time_of_one():
+    # All sockets share the TestClient's single event loop, so a blocking stream would serialize them
+    with TestClient(backend.app) as client:
+        started = time.monotonic()
+        single_answer = _chat(client, "hello from the only client")
+        single = time.monotonic() - started
+        assert single_answer.startswith("Simulated answer")
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=STREAMS) as pool:
+            # Distinct prompts, so single-flight can't merge them into one upstream stream
+            answers = list(pool.map(lambda i: _chat(client, f"hello from client {i}"), range(STREAMS)))
+        concurrent = time.monotonic() - started
+
+    assert all(answer.startswith("Simulated answer") for answer in answers)
+    assert len(set(answers)) == STREAMS
+    assert concurrent < single * 2, f"{STREAMS} streams took {concurrent:.2f}s; one took {single:.2f}s"
+
+
+class _BlockingCapableModel:
+    """Stands in for GenerativeModel: the sync API blocks per chunk, the async one awaits."""
+
+    chunk_delay = 0.05
+    chunks = 10
+
+    def generate_content(self, contents, stream=False):
+        def chunks():
+            for i in range(self.chunks):
+                time.sleep(self.chunk_delay)
+                yield backend._FakeChunk(f"Gemini part {i}. ")
+
+        return chunks()
+
+    async def generate_content_async(self, contents, stream=False):
+        async def chunks():
+            for i in range(self.chunks):
+                await backend.asyncio.sleep(self.chunk_delay)
+                yield backend._FakeChunk(f"Gemini part {i}. ")
+
+        return chunks()
+
+
+def test_gemini_provider_streams_do_not_block_each_other(monkeypatch):
+    # Exercises _GeminiProvider itself: going back to the blocking generate_content(stream=True) would serialize these
+    monkeypatch.setattr(backend, "_provider", backend._GeminiProvider())
+    monkeypatch.setattr(backend, "_get_model", lambda *args, **kwargs: _BlockingCapableModel())
+    with TestClient(backend.app) as client:
+        started = time.monotonic()
+        assert _chat(client, "hello gemini").startswith("Gemini part 0.")
+        single = time.monotonic() - started
+
+        started = time.monotonic()
+        with ThreadPoolExecutor(max_workers=STREAMS) as pool:
+            answers = list(pool.map(lambda i: _chat(client, f"hello gemini from client {i}"), range(STREAMS)))
+        concurrent = time.monotonic() - started
+
+    assert all(answer.startswith("Gemini part 0.") for answer in answers)
+    assert concurrent < single * 2, f"{STREAMS} streams took {concurrent:.2f}s; one took {single:.2f}s"
@@ -0,0 +1,50 @@
+import asyncio
+import json
+import time
+
+from fastapi.testclient import TestClient
+
+import app as backend
+
+
+def _turn(ws, prompt, suggestions=True):
+    ws.send_text(json.dumps({"prompt": prompt, "suggestions": suggestions}))
+    frames = []
+    while (frame := ws.receive_text()) != "[END]":
+        frames.append(frame)
+    return frames
+
+
+def test_slow_suggestions_do_not_block_the_next_turn(monkeypatch):
+    async def slow_suggest(text, latency_budget_ms=None):
+        await asyncio.sleep(5)
+        return ["never sent"]
+
+    monkeypatch.setattr(backend, "_suggest", slow_suggest)
+    with TestClient(backend.app) as client:
+        with client.websocket_connect("/ws/chat") as ws:
+            _turn(ws, "first question")
+            started = time.perf_counter()
+            frames = _turn(ws, "second question", suggestions=False)
+            elapsed = time.perf_counter() - started
+    assert elapsed < 3
+    assert frames and not any("never sent" in frame for frame in frames)
+
+
+def test_suggestions_follow_successful_answers_only(monkeypatch):
+    calls = []
+
+    async def fake_suggest(text, latency_budget_ms=None):
+        calls.append(text)
+        return ["a follow-up"]
+
+    monkeypatch.setattr(backend, "_suggest", fake_suggest)
+    with TestClient(backend.app) as client:
+        with client.websocket_connect("/ws/chat") as ws:
+            _turn(ws, "a good question")
+            assert json.loads(ws.receive_text()) == {"type": "suggestions", "suggestions": ["a follow-up"]}
+            monkeypatch.setattr(backend._provider, "error_rate", 1.0)
+            monkeypatch.setattr(backend, "GEMINI_MAX_RETRIES", 0)
+            assert json.loads(_turn(ws, "a failing question")[0])["type"] == "error"
+            _turn(ws, "another failing question", suggestions=False)
+    assert len(calls) == 1